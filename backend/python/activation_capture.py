@@ -0,0 +1,84 @@
+import torch
+
+
+class ActivationCapture:
+    """
+    Captures per-token hidden states from a set of layers into a preallocated ring buffer.
+
+    The buffer is a contiguous [n_layers, max_tokens, hidden_size] host tensor (pinned when
+    CUDA is available), so each decode step costs one asynchronous device-to-host copy per
+    layer instead of a numpy conversion and a Python list of floats. Reads wait for the
+    outstanding copies before handing out numpy views of the buffer.
+    """
+
+    def __init__(self, layer_names, max_tokens, hidden_size, dtype=torch.float32):
+        """
+        Initialize the capture buffer.
+
+        :param layer_names: Names of the modules whose output is captured
+        :param max_tokens: Number of decode steps kept per layer before the ring wraps
+        :param hidden_size: Width of the captured hidden states
+        :param dtype: Storage dtype of the buffer (torch.float32 or torch.float16)
+        """
+        self.layer_names = list(layer_names)
+        self.layer_index = {name: i for i, name in enumerate(self.layer_names)}
+        self.max_tokens = max_tokens
+        self.hidden_size = hidden_size
+        self.dtype = dtype
+        self.buffer = torch.empty(
+            (len(self.layer_names), max_tokens, hidden_size),
+            dtype=dtype,
+            pin_memory=torch.cuda.is_available(),
+        )
+        self.counts = [0] * len(self.layer_names)
+        self._copy_events = [None] * len(self.layer_names)
+
+    def reset(self):
+        self.counts = [0] * len(self.layer_names)
+        self._copy_events = [None] * len(self.layer_names)
+
+    def record(self, layer_name, hidden_state):
+        """
+        Copy the last position of a [batch, seq, hidden] hidden state into the ring buffer.
+        """
+        i = self.layer_index[layer_name]
+        slot = self.counts[i] % self.max_tokens
+        self.buffer[i, slot].copy_(hidden_state[0, -1], non_blocking=True)
+        if hidden_state.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+            self._copy_events[i] = event
+        self.counts[i] += 1
+
+    def count(self, layer_name):
+        return self.counts[self.layer_index[layer_name]]
+
+    def read(self, layer_name, start, end):
+        """
+        Return the activations captured for steps [start, end) as a numpy array.
+
+        Steps that have already been overwritten by the ring are not returned.
+        """
+        i = self.layer_index[layer_name]
+        event = self._copy_events[i]
+        if event is not None:
+            event.synchronize()
+        start = max(start, end - self.max_tokens, 0)
+        if start >= end:
+            return self.buffer[i, :0].numpy()
+        first, last = start % self.max_tokens, (end - 1) % self.max_tokens
+        if first <= last:
+            return self.buffer[i, first:last + 1].numpy()
+        return torch.cat((self.buffer[i, first:], self.buffer[i, :last + 1])).numpy()
+
+    def capture_output(self, layer_name, output):
+        """
+        Record a module output if it is a single-token (decode step) hidden state.
+
+        Returns True when the output was recorded.
+        """
+        hidden_state = output[0] if isinstance(output, tuple) else output
+        if hidden_state.dim() == 3 and hidden_state.shape[1] == 1:
+            self.record(layer_name, hidden_state.detach())
+            return True
+        return False
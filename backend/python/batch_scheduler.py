@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import onnxruntime_genai as og
+from metrics import timed, tokens_generated
+from log_setup import trace_token
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a prompt is submitted while the scheduler queue is at capacity.
+    """
+
+
+class GenerationRequest:
+    """
+    A prompt waiting for, or taking part in, a batched generation.
+
+    Iterating over the request yields decoded tokens as the scheduler produces them.
+    """
+
+    _done = object()
+
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.error = None
+        self.enqueued_at = time.perf_counter()
+        self._tokens = queue.Queue()
+
+    def put_token(self, token):
+        self._tokens.put(token)
+
+    def finish(self, error=None):
+        self.error = error
+        self._tokens.put(self._done)
+
+    def __iter__(self):
+        while True:
+            token = self._tokens.get()
+            if token is self._done:
+                break
+            yield token
+        if self.error is not None:
+            raise self.error
+
+
+def load_eos_token_ids(model_path):
+    # Read the end-of-sequence ids from the genai config shipped next to the ONNX model
+    with open(os.path.join(model_path, 'genai_config.json'), 'r') as config_file:
+        eos_token_id = json.load(config_file)['model']['eos_token_id']
+    return set(eos_token_id) if isinstance(eos_token_id, list) else {eos_token_id}
+
+
+class BatchScheduler:
+    """
+    Runs queued prompts together in batched og.Generator passes.
+
+    A single background thread drains the queue: it takes up to max_batch_size waiting
+    prompts, decodes them in one generator and hands every token to its request as soon
+    as it is produced. A sequence that reaches end-of-sequence is released to its caller
+    straight away, and prompts that arrive meanwhile join the next batch.
+
+    og.Generator cannot take new sequences mid-generation, so a batch runs until its
+    longest sequence finishes. One long generation (up to max_length tokens) therefore
+    holds every queued prompt back until it is done; lower max_length in the search
+    options to bound that wait.
+    """
+
+    def __init__(self, registry, model_path, search_options, max_batch_size=4, max_queue_depth=32, batch_wait=0.01, offload=None):
+        """
+        Initialize the scheduler.
+
+        :param registry: ModelRegistry providing the (model, tokenizer) pair
+        :param model_path: Path of the ONNX model to run
+        :param search_options: Search options passed to og.GeneratorParams
+        :param max_batch_size: Maximum number of prompts decoded together
+        :param max_queue_depth: Maximum number of prompts waiting for a batch
+        :param batch_wait: Seconds to wait for more prompts before starting a partial batch
+        :param offload: Optional callable used to run each decode step off the event loop
+        """
+        self.registry = registry
+        self.model_path = model_path
+        self.search_options = search_options
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.offload = offload or (lambda fn, *args: fn(*args))
+        self._queue = queue.Queue(maxsize=max_queue_depth)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._eos_token_ids = None
+
+    def submit(self, prompt):
+        """
+        Queue a prompt and return its GenerationRequest.
+
+        Raises QueueFullError when max_queue_depth prompts are already waiting.
+        """
+        self._ensure_started()
+        generation_request = GenerationRequest(prompt)
+        try:
+            self._queue.put_nowait(generation_request)
+        except queue.Full:
+            raise QueueFullError(f"Generation queue is full ({self._queue.maxsize} waiting).")
+        return generation_request
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="og-batch-scheduler", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                logger.exception(f"Error during batched generation: {e}")
+                for generation_request in batch:
+                    generation_request.finish(error=e)
+
+    def _run_batch(self, batch):
+        with self.registry.acquire(self.model_path) as (model, tokenizer):
+            if self._eos_token_ids is None:
+                self._eos_token_ids = load_eos_token_ids(self.model_path)
+
+            params = og.GeneratorParams(model)
+            params.try_graph_capture_with_max_batch_size(self.max_batch_size)
+            params.set_search_options(**self.search_options)
+            with timed('tokenization'):
+                params.input_ids = tokenizer.encode_batch([r.prompt for r in batch])
+
+            generator = self.offload(og.Generator, model, params)
+            tokenizer_streams = [tokenizer.create_stream() for _ in batch]
+            active = [True] * len(batch)
+
+            def decode_step():
+                generator.compute_logits()
+                generator.generate_next_token()
+                return generator.get_next_tokens()
+
+            while any(active) and not generator.is_done():
+                with timed('decode'):
+                    new_tokens = self.offload(decode_step)
+                for i, generation_request in enumerate(batch):
+                    if not active[i]:
+                        continue
+                    new_token = int(new_tokens[i])
+                    if new_token in self._eos_token_ids:
+                        active[i] = False
+                        generation_request.finish()
+                        continue
+                    generation_request.put_token(tokenizer_streams[i].decode(new_token))
+                    trace_token(logger, model='phi3_onnx', sequence=i, token_id=new_token)
+                    tokens_generated.inc(model='phi3_onnx')
+
+            for i, generation_request in enumerate(batch):
+                if active[i]:
+                    generation_request.finish()
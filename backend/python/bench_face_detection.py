@@ -0,0 +1,47 @@
+import argparse
+import time
+import cv2
+from face_detection import DnnFaceDetector, HaarFaceDetector
+
+# Compare face-detection latency of the original full-resolution Haar pass against the
+# downscaled Haar and DNN detectors on a set of images.
+
+def full_resolution_haar(cascade):
+    def detect(img):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+    return detect
+
+def time_detector(detect, images, repeats):
+    detect(images[0])
+    face_counts = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        face_counts = [len(detect(img)) for img in images]
+    elapsed = (time.perf_counter() - start) / (repeats * len(images))
+    return elapsed, face_counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark face detectors.")
+    parser.add_argument("images", nargs="+", help="Image files to run the detectors on")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max-long-edge", type=int, default=640)
+    args = parser.parse_args()
+
+    images = [cv2.imread(path) for path in args.images]
+    images = [img for img in images if img is not None]
+    print(f"Loaded {len(images)} images, sizes: {sorted({img.shape[:2] for img in images})}")
+
+    haar = HaarFaceDetector(max_long_edge=args.max_long_edge)
+    detectors = {
+        'haar (full resolution)': full_resolution_haar(haar.cascade),
+        f'haar (long edge {args.max_long_edge})': haar.detect,
+    }
+    try:
+        detectors['dnn'] = DnnFaceDetector().detect
+    except cv2.error as e:
+        print(f"Skipping DNN detector, model files not available: {e}")
+
+    for name, detect in detectors.items():
+        elapsed, face_counts = time_detector(detect, images, args.repeats)
+        print(f"{name}: {elapsed * 1e3:.1f} ms per image, faces found: {face_counts}")
@@ -0,0 +1,57 @@
+import threading
+import time
+from model_registry import ModelRegistry
+
+# Check the registry's pinning and eviction rules with a stub loader, then time the
+# cached lookup path that every request goes through.
+
+def stub_loader(load_counts):
+    def load(model_path):
+        load_counts[model_path] = load_counts.get(model_path, 0) + 1
+        return f"model:{model_path}", f"tokenizer:{model_path}"
+    return load
+
+
+def check_pinned_slots():
+    load_counts = {}
+    registry = ModelRegistry(stub_loader(load_counts), max_models=1)
+
+    # Every slot is pinned, so B must still be loaded once and returned
+    entry_a = registry.get('A')
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('entry', registry.get('B')))
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive(), "get() did not return while every slot was pinned"
+    entry_b = result['entry']
+    assert entry_b.model == "model:B" and load_counts == {'A': 1, 'B': 1}, load_counts
+
+    # Releasing A brings the registry back under max_models; B is still in use
+    registry.release(entry_a)
+    assert list(registry.stats()['resident']) == ['B']
+    registry.release(entry_b)
+    with registry.acquire('B') as (model, tokenizer):
+        assert model == "model:B"
+    assert load_counts == {'A': 1, 'B': 1}, load_counts
+
+    # An idle least recently used entry is evicted
+    with registry.acquire('C'):
+        pass
+    assert list(registry.stats()['resident']) == ['C'] and registry.stats()['evictions'] == 2
+    print("Registry checks passed.")
+
+
+def time_hits(iterations=100000):
+    registry = ModelRegistry(stub_loader({}), max_models=1)
+    registry.warm_up(['A'])
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with registry.acquire('A'):
+            pass
+    elapsed = time.perf_counter() - start
+    print(f"Cached acquire/release: {elapsed / iterations * 1e6:.2f} us per lookup")
+
+
+if __name__ == "__main__":
+    check_pinned_slots()
+    time_hits()
@@ -0,0 +1,80 @@
+import time
+import torch
+import torch.nn.functional as F
+from sampling import sample_next_tokens
+
+# Sanity-check the sampled distribution, then time the sampler against the
+# per-row hook implementation it replaced.
+
+vocab_size = 32064
+batch_size = 8
+iterations = 200
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def check_distribution(num_samples=200000):
+    logits = torch.log(torch.tensor([[0.5, 0.3, 0.15, 0.05]]))
+    generator = torch.Generator().manual_seed(0)
+
+    # Plain sampling follows softmax(logits)
+    draws = sample_next_tokens(logits.expand(num_samples, -1), generator=generator)
+    frequencies = torch.bincount(draws, minlength=4).float() / num_samples
+    print(f"Sampled frequencies: {frequencies.tolist()}")
+    assert torch.allclose(frequencies, torch.tensor([0.5, 0.3, 0.15, 0.05]), atol=0.01)
+
+    # top_p=0.7 keeps tokens 0 and 1, renormalized
+    draws = sample_next_tokens(logits.expand(num_samples, -1), top_p=0.7, generator=generator)
+    frequencies = torch.bincount(draws, minlength=4).float() / num_samples
+    print(f"top_p=0.7 frequencies: {frequencies.tolist()}")
+    assert torch.allclose(frequencies, torch.tensor([0.625, 0.375, 0.0, 0.0]), atol=0.01)
+
+    # top_k=1 and greedy decoding agree
+    assert (sample_next_tokens(logits, top_k=1) == 0).all()
+    assert (sample_next_tokens(logits, do_sample=False) == 0).all()
+
+    # Banned tokens and the repetition penalty move the argmax
+    assert (sample_next_tokens(logits, banned_token_ids=[0], do_sample=False) == 1).all()
+    previous_tokens = torch.tensor([[0]])
+    assert (sample_next_tokens(logits, repetition_penalty=2.0, previous_tokens=previous_tokens, do_sample=False) == 1).all()
+    print("Distribution checks passed.")
+
+
+def legacy_hook_sampling(activation, temperature=0.7, top_k=50, top_p=0.9):
+    # The sampling previously done inside the lm_head hook, one row at a time
+    probabilities = F.softmax(activation / temperature, dim=-1)
+    top_k_probabilities, top_k_indices = torch.topk(probabilities, top_k, dim=-1)
+    sorted_probabilities, sorted_indices = torch.sort(top_k_probabilities, descending=True)
+    cumulative_probabilities = torch.cumsum(sorted_probabilities, dim=-1)
+    cutoff_index = torch.where(cumulative_probabilities >= top_p)[1][0].item()
+    top_p_indices = sorted_indices[:, :cutoff_index + 1]
+    top_p_probabilities = sorted_probabilities[:, :cutoff_index + 1]
+    chosen_index = torch.multinomial(top_p_probabilities, 1)
+    return top_k_indices[0, top_p_indices[0, chosen_index]].item()
+
+
+def time_it(fn):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == "__main__":
+    check_distribution()
+
+    logits = torch.randn(batch_size, vocab_size, device=device)
+    previous_tokens = torch.randint(0, vocab_size, (batch_size, 64), device=device)
+
+    legacy = time_it(lambda: [legacy_hook_sampling(logits[i:i + 1]) for i in range(batch_size)])
+    batched = time_it(lambda: sample_next_tokens(
+        logits, temperature=0.7, top_k=50, top_p=0.9,
+        repetition_penalty=1.1, previous_tokens=previous_tokens,
+    ))
+    print(f"Device: {device}, batch size: {batch_size}, vocab size: {vocab_size}")
+    print(f"Per-row hook sampling: {legacy * 1e3:.3f} ms per step")
+    print(f"Batched sampling:      {batched * 1e3:.3f} ms per step")
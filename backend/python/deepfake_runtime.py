@@ -0,0 +1,136 @@
+import os
+import json
+import logging
+import numpy as np
+from startup import timed_import
+
+logger = logging.getLogger(__name__)
+
+# Paths to the model files
+models_dir = os.path.join(os.path.dirname(__file__), 'models')
+model_weights_path = os.path.join(models_dir, 'model.weights.h5')
+model_config_path = os.path.join(models_dir, 'config.json')
+onnx_model_path = os.path.join(models_dir, 'deepfake_model.onnx')
+tflite_model_path = os.path.join(models_dir, 'deepfake_model_int8.tflite')
+
+input_size = 224
+
+def build_keras_model():
+    tf = timed_import('tensorflow')
+
+    # Load the model architecture from the config file
+    with open(model_config_path, 'r') as json_file:
+        model_config = json.load(json_file)
+
+    # Reconstruct the model from the JSON configuration
+    model = tf.keras.models.model_from_json(
+        json.dumps(model_config),
+        custom_objects={"EfficientNetV2Backbone": tf.keras.applications.EfficientNetV2B0}
+    )
+
+    # Build the model with the defined input shape
+    model(np.zeros((1, input_size, input_size, 3)))
+
+    # Load the model weights
+    model.load_weights(model_weights_path)
+    return model
+
+class KerasBackend:
+    """
+    Full-precision TensorFlow inference through a compiled tf.function.
+    """
+
+    def __init__(self):
+        tf = timed_import('tensorflow')
+        self.tf = tf
+        self.model = build_keras_model()
+
+        # The batch dimension is left open so one trace serves every batch size
+        @tf.function(input_signature=[tf.TensorSpec(shape=(None, input_size, input_size, 3), dtype=tf.float32)])
+        def predict(images):
+            return self.model(images, training=False)
+
+        self._predict = predict
+
+    def predict_batch(self, images):
+        return self._predict(self.tf.convert_to_tensor(images)).numpy()
+
+class OnnxBackend:
+    """
+    ONNX Runtime inference on the model exported by export_deepfake_model.py.
+    """
+
+    def __init__(self, model_path=onnx_model_path):
+        ort = timed_import('onnxruntime')
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_batch(self, images):
+        return self.session.run(None, {self.input_name: images.astype(np.float32)})[0]
+
+class TFLiteBackend:
+    """
+    int8-quantized TFLite inference on the model exported by export_deepfake_model.py.
+    """
+
+    def __init__(self, model_path=tflite_model_path):
+        # The standalone runtime is much smaller than TensorFlow; fall back to TensorFlow if it is missing
+        try:
+            Interpreter = timed_import('tflite_runtime.interpreter').Interpreter
+        except ImportError:
+            Interpreter = timed_import('tensorflow').lite.Interpreter
+        self.interpreter = Interpreter(model_path=model_path, num_threads=os.cpu_count())
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_detail = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    def _quantize(self, images):
+        scale, zero_point = self.input_detail['quantization']
+        if self.input_detail['dtype'] == np.float32 or scale == 0:
+            return images.astype(np.float32)
+        info = np.iinfo(self.input_detail['dtype'])
+        return np.clip(np.round(images / scale + zero_point), info.min, info.max).astype(self.input_detail['dtype'])
+
+    def _dequantize(self, outputs):
+        scale, zero_point = self.output_detail['quantization']
+        if self.output_detail['dtype'] == np.float32 or scale == 0:
+            return outputs
+        return (outputs.astype(np.float32) - zero_point) * scale
+
+    def predict_batch(self, images):
+        # The interpreter is resized only when the batch size changes
+        if images.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_detail['index'], images.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = images.shape[0]
+        self.interpreter.set_tensor(self.input_detail['index'], self._quantize(images))
+        self.interpreter.invoke()
+        return self._dequantize(self.interpreter.get_tensor(self.output_detail['index']))
+
+# Model file each runtime serves from; its modification time versions cached results
+deepfake_model_paths = {
+    'keras': model_weights_path,
+    'onnx': onnx_model_path,
+    'tflite': tflite_model_path,
+}
+
+deepfake_backends = {
+    'keras': KerasBackend,
+    'onnx': OnnxBackend,
+    'tflite': TFLiteBackend,
+}
+
+def load_deepfake_backend(name=None):
+    """
+    Create the deepfake inference backend selected by name or by DEEPFAKE_RUNTIME.
+
+    :param name: One of 'keras', 'onnx' or 'tflite'; defaults to DEEPFAKE_RUNTIME or 'keras'
+    :return: Backend exposing predict_batch(images)
+    """
+    name = name or os.getenv('DEEPFAKE_RUNTIME', 'keras')
+    if name not in deepfake_backends:
+        raise ValueError(f"Unknown deepfake runtime '{name}', expected one of {sorted(deepfake_backends)}.")
+    logger.info(f"Loading deepfake model with the {name} runtime.")
+    return deepfake_backends[name]()
@@ -0,0 +1,95 @@
+import argparse
+import glob
+import os
+import sys
+import cv2
+import numpy as np
+import tensorflow as tf
+from deepfake_runtime import (
+    OnnxBackend,
+    TFLiteBackend,
+    build_keras_model,
+    input_size,
+    onnx_model_path,
+    tflite_model_path,
+)
+from face_detection import load_face_detector, prepare_model_input
+
+# Export the EfficientNetV2 deepfake model to ONNX and int8 TFLite, then check that
+# both exports agree with the Keras model on a sample set of images.
+
+def load_sample_images(sample_dir, limit, use_face_crop):
+    paths = sorted(
+        path for pattern in ('*.jpg', '*.jpeg', '*.png')
+        for path in glob.glob(os.path.join(sample_dir, pattern))
+    )[:limit]
+    face_detector = load_face_detector()
+    images = []
+    for path in paths:
+        img = cv2.imread(path)
+        if img is None:
+            print(f"Skipping unreadable image: {path}")
+            continue
+        # Same face detection and preprocessing as analyze_worker_data
+        faces = face_detector.detect(img)
+        if len(faces) == 0:
+            print(f"Skipping image without a detected face: {path}")
+            continue
+        images.append(prepare_model_input(img, faces, input_size, use_face_crop))
+    if not images:
+        raise ValueError(f"No sample images found in {sample_dir}.")
+    print(f"Loaded {len(images)} sample images from {sample_dir}.")
+    return np.stack(images)
+
+def export_onnx(model, output_path):
+    import tf2onnx
+    input_signature = [tf.TensorSpec((None, input_size, input_size, 3), tf.float32, name="images")]
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=13, output_path=output_path)
+    print(f"ONNX model written to {output_path}.")
+
+def export_tflite_int8(model, sample_images, output_path):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    # Calibrate the activation ranges on the sample set
+    def representative_dataset():
+        for image in sample_images:
+            yield [image[np.newaxis]]
+
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f"int8 TFLite model written to {output_path}.")
+
+def check_parity(name, reference, predictions, max_abs_diff, min_agreement):
+    abs_diff = np.abs(reference - predictions).max()
+    # Agreement on the real/fake decision taken by analyze_worker_data
+    agreement = np.mean((reference < 0.5) == (predictions < 0.5))
+    passed = abs_diff <= max_abs_diff and agreement >= min_agreement
+    print(f"{name}: max abs diff {abs_diff:.4f}, decision agreement {agreement:.2%} -> {'OK' if passed else 'FAILED'}")
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the deepfake model to ONNX and int8 TFLite.")
+    parser.add_argument("--sample-dir", required=True, help="Directory of profile pictures used for calibration and parity checks")
+    parser.add_argument("--deepfake-input", choices=("face", "image"), default=os.getenv('DEEPFAKE_INPUT', 'face'), help="Model input used in serving, as DEEPFAKE_INPUT")
+    parser.add_argument("--sample-limit", type=int, default=200)
+    parser.add_argument("--onnx-path", default=onnx_model_path)
+    parser.add_argument("--tflite-path", default=tflite_model_path)
+    parser.add_argument("--max-abs-diff", type=float, default=0.1)
+    parser.add_argument("--min-agreement", type=float, default=0.98)
+    args = parser.parse_args()
+
+    model = build_keras_model()
+    sample_images = load_sample_images(args.sample_dir, args.sample_limit, args.deepfake_input == 'face')
+    reference = model.predict(sample_images)
+
+    export_onnx(model, args.onnx_path)
+    export_tflite_int8(model, sample_images, args.tflite_path)
+
+    passed = check_parity("onnx", reference, OnnxBackend(args.onnx_path).predict_batch(sample_images), args.max_abs_diff, args.min_agreement)
+    passed &= check_parity("tflite", reference, TFLiteBackend(args.tflite_path).predict_batch(sample_images), args.max_abs_diff, args.min_agreement)
+    sys.exit(0 if passed else 1)
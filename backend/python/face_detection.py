@@ -0,0 +1,131 @@
+import os
+import threading
+import cv2
+import numpy as np
+
+models_dir = os.path.join(os.path.dirname(__file__), 'models')
+
+# OpenCV's ResNet-10 SSD face detector (deploy.prototxt and weights from the OpenCV samples)
+dnn_prototxt_path = os.getenv('FACE_DNN_PROTOTXT', os.path.join(models_dir, 'deploy.prototxt'))
+dnn_weights_path = os.getenv('FACE_DNN_WEIGHTS', os.path.join(models_dir, 'res10_300x300_ssd_iter_140000.caffemodel'))
+
+def downscale(img, max_long_edge):
+    """
+    Shrink img so its long edge is at most max_long_edge.
+
+    :return: (resized image, scale factor from the resized image back to the original)
+    """
+    height, width = img.shape[:2]
+    long_edge = max(height, width)
+    if max_long_edge is None or long_edge <= max_long_edge:
+        return img, 1.0
+    ratio = max_long_edge / long_edge
+    resized = cv2.resize(img, (round(width * ratio), round(height * ratio)), interpolation=cv2.INTER_AREA)
+    return resized, 1.0 / ratio
+
+def scale_boxes(boxes, scale):
+    return [tuple(int(round(v * scale)) for v in box) for box in boxes]
+
+class HaarFaceDetector:
+    """
+    Haar cascade face detection run on a downscaled grayscale copy of the image.
+    """
+
+    def __init__(self, max_long_edge=640, scale_factor=1.1, min_neighbors=5, min_size=30):
+        self.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        self.max_long_edge = max_long_edge
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+
+    def detect(self, img):
+        """
+        Return face boxes as (x, y, w, h) in the coordinates of the original image.
+        """
+        small, scale = downscale(img, self.max_long_edge)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        # Keep the minimum face size relative to the original resolution, but never below 20px
+        min_size = max(int(self.min_size / scale), 20)
+        boxes = self.cascade.detectMultiScale(
+            gray,
+            scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors,
+            minSize=(min_size, min_size),
+        )
+        return scale_boxes(boxes, scale)
+
+class DnnFaceDetector:
+    """
+    OpenCV DNN (ResNet-10 SSD) face detection on a 300x300 blob of the image.
+
+    A cv2.dnn.Net holds its input between setInput() and forward(), so each worker
+    thread runs its own copy of the network.
+    """
+
+    def __init__(self, confidence_threshold=0.5, prototxt_path=dnn_prototxt_path, weights_path=dnn_weights_path):
+        self.prototxt_path = prototxt_path
+        self.weights_path = weights_path
+        self.confidence_threshold = confidence_threshold
+        self._local = threading.local()
+        # Loaded once up front so missing model files fail at startup
+        self._local.net = cv2.dnn.readNetFromCaffe(prototxt_path, weights_path)
+
+    def _net(self):
+        net = getattr(self._local, 'net', None)
+        if net is None:
+            net = self._local.net = cv2.dnn.readNetFromCaffe(self.prototxt_path, self.weights_path)
+        return net
+
+    def detect(self, img):
+        """
+        Return face boxes as (x, y, w, h) in the coordinates of the original image.
+        """
+        height, width = img.shape[:2]
+        # blobFromImage does the downscale, so the full image is never processed at full size
+        blob = cv2.dnn.blobFromImage(img, 1.0, (300, 300), (104.0, 177.0, 123.0))
+        net = self._net()
+        net.setInput(blob)
+        detections = net.forward()[0, 0]
+
+        boxes = []
+        for detection in detections[detections[:, 2] >= self.confidence_threshold]:
+            x1, y1, x2, y2 = (detection[3:7] * np.array([width, height, width, height])).astype(int)
+            x1, y1 = max(x1, 0), max(y1, 0)
+            x2, y2 = min(x2, width), min(y2, height)
+            if x2 > x1 and y2 > y1:
+                boxes.append((x1, y1, x2 - x1, y2 - y1))
+        return boxes
+
+face_detectors = {
+    'haar': HaarFaceDetector,
+    'dnn': DnnFaceDetector,
+}
+
+def load_face_detector(name=None):
+    """
+    Create the face detector selected by name or by FACE_DETECTOR ('haar' or 'dnn').
+    """
+    name = name or os.getenv('FACE_DETECTOR', 'haar')
+    if name not in face_detectors:
+        raise ValueError(f"Unknown face detector '{name}', expected one of {sorted(face_detectors)}.")
+    if name == 'haar':
+        return HaarFaceDetector(max_long_edge=int(os.getenv('FACE_DETECTION_MAX_EDGE', '640')))
+    return DnnFaceDetector(confidence_threshold=float(os.getenv('FACE_DNN_CONFIDENCE', '0.5')))
+
+def crop_face(img, boxes, margin=0.2):
+    """
+    Crop the largest face box from img, padded by margin on every side.
+    """
+    x, y, w, h = max(boxes, key=lambda box: box[2] * box[3])
+    pad_x, pad_y = int(w * margin), int(h * margin)
+    height, width = img.shape[:2]
+    return img[max(y - pad_y, 0):min(y + h + pad_y, height), max(x - pad_x, 0):min(x + w + pad_x, width)]
+
+def prepare_model_input(img, faces, input_size, use_face_crop=True):
+    """
+    Build the deepfake model input: the padded crop of the largest face (or the whole
+    image), resized to input_size and scaled to [0, 1].
+    """
+    model_input = crop_face(img, faces) if use_face_crop else img
+    img_array = cv2.resize(model_input, (input_size, input_size), interpolation=cv2.INTER_AREA)
+    return img_array.astype('float32') / 255.0
@@ -1,194 +1,155 @@
-import json
+import os
 import torch
-import torch.nn.functional as F
-import numpy as np
 import onnxruntime_genai as og
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-from flask import request, jsonify
-from sklearn.manifold import TSNE
-import traceback
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache, LogitsProcessorList, TextIteratorStreamer
+from flask import request, jsonify, copy_current_request_context
+import logging
+import threading
 from flask_socketio import emit
-
-# Global variables to store the model and tokenizer
-model = None
-tokenizer = None
-hook_handles = []
+from model_registry import ModelRegistry
+from batch_scheduler import BatchScheduler, QueueFullError
+from inference_session import InferenceSession
+from prefix_cache import PrefixCache
+from projection import ProjectionEngine, projection_backends, to_points
+from sampling import SamplingLogitsProcessor
+from streaming import stream_events, sse_response
+from serving import offload
+from metrics import cache_lookups, timed, tokens_generated
+from log_setup import log_fields
+
+logger = logging.getLogger(__name__)
+
+# Global inference session for the Hugging Face model, built on first use
+session = None
 
 def load_model_og(model_path):
-    print(f"Loading model from: {model_path}")
+    logger.info(f"Loading model from: {model_path}")
     model = og.Model(model_path)
-    print("Model loaded successfully.")
+    logger.info("Model loaded successfully.")
     return model
 
 def load_tokenizer_og(model):
-    print("Loading tokenizer for the model.")
+    logger.debug("Loading tokenizer for the model.")
     tokenizer = og.Tokenizer(model)
-    print("Tokenizer loaded successfully.")
+    logger.info("Tokenizer loaded successfully.")
     return tokenizer
 
-def run_inference_og(model, tokenizer, input_text):
-    print(f"Running inference for input text: {input_text}")
-    search_options = {"max_length": 1024, "temperature": 0.3}
-    params = og.GeneratorParams(model)
-    params.try_graph_capture_with_max_batch_size(1)
-    params.set_search_options(**search_options)
-
-    prompt = f"<|user|>{input_text}<|end|><|assistant|>"
-    
-    input_tokens = tokenizer.encode(prompt)
-    print(f"Encoded input tokens: {input_tokens}")
-    params.input_ids = input_tokens
-
-    generator = og.Generator(model, params)
-    tokenizer_stream = tokenizer.create_stream()
-    
-    generated_text = ""
-
-    # Run the generator to completion
-    while not generator.is_done():
-        generator.compute_logits()
-        generator.generate_next_token()
-
-        # Get the new token and decode it
-        new_token = generator.get_next_tokens()[0]
-        decoded_token = tokenizer_stream.decode(new_token)
-        print(f"Generated token: {new_token}, Decoded token: {decoded_token}")
-        generated_text += decoded_token
+def load_model_and_tokenizer_og(model_path):
+    model = load_model_og(model_path)
+    tokenizer = load_tokenizer_og(model)
+    return model, tokenizer
 
-    print(f"Final generated text: {generated_text}")
-    return generated_text
+# Path of the Phi-3 ONNX model served by run_inference_with_phi3_mini_endpoint
+phi3_model_path = "./models/phi-3-mini-4k-instruct-onnx-directml-int4-awq"
+
+# Resident ONNX models shared by every request in the process
+og_model_registry = ModelRegistry(lambda model_path: offload(load_model_and_tokenizer_og, model_path), max_models=int(os.getenv('OG_MAX_RESIDENT_MODELS', '1')))
+
+# Search options shared by the single-request and batched ONNX paths
+og_search_options = {"max_length": 1024, "temperature": 0.3}
+
+# Concurrent prompts are decoded together by a single batched generator
+og_batch_scheduler = BatchScheduler(
+    og_model_registry,
+    phi3_model_path,
+    og_search_options,
+    max_batch_size=int(os.getenv('OG_MAX_BATCH_SIZE', '4')),
+    max_queue_depth=int(os.getenv('OG_MAX_QUEUE_DEPTH', '32')),
+    offload=offload,
+)
+
+def format_prompt_og(input_text):
+    return f"<|user|>{input_text}<|end|><|assistant|>"
+
+def stream_inference_with_phi3_mini(input_text):
+    # Submitting eagerly lets QueueFullError reach the caller before any event is sent
+    generation_request = og_batch_scheduler.submit(format_prompt_og(input_text))
+    return stream_events(generation_request)
+
+def stream_inference_with_phi3_mini_endpoint():
+    data = request.json
+    input_text = data.get('input_text', '')
+    logger.debug("Received input text for streaming", **log_fields(input_text=input_text))
+    try:
+        events = stream_inference_with_phi3_mini(input_text)
+    except QueueFullError as e:
+        logger.warning(f"Rejecting inference request: {e}")
+        return jsonify({'success': False, 'message': 'Server is busy, please try again later.'}), 503
+    return sse_response(events)
 
 def run_inference_with_phi3_mini_endpoint():
     try:
         data = request.json
         input_text = data.get('input_text', '')
-        print(f"Received input text: {input_text}")
-        model_path = "./models/phi-3-mini-4k-instruct-onnx-directml-int4-awq"
-        model = load_model_og(model_path)
-        tokenizer = load_tokenizer_og(model)
-        generated_text = run_inference_og(model, tokenizer, input_text)
-        print("Generated text:", generated_text)
+        logger.debug("Received input text", **log_fields(input_text=input_text))
+        generation_request = og_batch_scheduler.submit(format_prompt_og(input_text))
+        generated_text = "".join(generation_request)
+        logger.debug("Generated text", **log_fields(output=generated_text))
         return jsonify({'success': True, 'output': generated_text})
+    except QueueFullError as e:
+        logger.warning(f"Rejecting inference request: {e}")
+        return jsonify({'success': False, 'message': 'Server is busy, please try again later.'}), 503
     except Exception as e:
-        print(f"Error during inference: {e}")
-        traceback.print_exc()
+        logger.exception(f"Error during inference: {e}")
         return jsonify({'success': False, 'message': 'Internal server error.'}), 500
     
-# Global variables to store activations
-batched_activations = []
-predicted_tokens = []
-activations_count = 0
-lm_head_activations_count = 0
+# Layers whose decode-step activations are captured and projected
+activation_layers = os.getenv('ACTIVATION_LAYERS', 'model.layers.31').split(',')
+activation_dtype = torch.float16 if os.getenv('ACTIVATION_DTYPE') == 'float16' else torch.float32
+
+# Online 3D projection per captured layer; the fitted space is kept across requests.
+# Activations are projected every projection_interval decode steps: each read waits for
+# the pending device-to-host copy, so projecting every step would make it synchronous.
+projection_backend = os.getenv('PROJECTION_BACKEND', 'pca')
+projection_interval = int(os.getenv('PROJECTION_INTERVAL', '10'))
+projection_engines = {
+    name: ProjectionEngine(projection_backends[projection_backend]())
+    for name in activation_layers
+}
+
+# Base generation arguments; max_new_tokens is also the activation capture ring size
+generation_args = {
+    "max_new_tokens": 50,
+    "return_full_text": False,
+    "do_sample": False,  # The sampling processor makes the choice
+}
+
+# Concurrent generations allowed on the shared HF model
+max_concurrent_generations = int(os.getenv('MAX_CONCURRENT_GENERATIONS', '1'))
+
+def emit_pending_activations(request_context, name):
+    activation_capture = request_context.activation_capture
+    end = activation_capture.count(name)
+    pending = activation_capture.read(name, request_context.emitted_activations[name], end)
+    request_context.emitted_activations[name] = end
+    if len(pending) == 0:
+        return []
+
+    # Project into the layer's fitted space; points held back during warm-up come out later
+    with timed('projection'):
+        json_results = to_points(projection_engines[name].add(pending), name)
+
+    # Emit the projected points to the frontend
+    if json_results:
+        emit('updateTSNEData', json_results, namespace="/", broadcast=True)
+    return json_results
 
-# Hook function to capture the activation and prepare t-SNE data
+# Hook function to capture the activation and stream its projection
 def get_activation(name):
-    def hook(model, input, output):
-        global batched_activations, activations_count
-        # print("Retrieving activation from Layer: ", name)
-        output = output[0]  # Ensure we are getting the correct part of the output
-        activation = output.detach().to(torch.float32)
-        activation_np = activation.cpu().numpy()
-        # print("Activation retrieved: ", activation_np)
-
-        # Print the shape of the activation
-        # print("Activation shape:", activation_np.shape)
-
-        # For now we want to capture singular activations from generated tokens as these
+    def hook(request_context, model, input, output):
+        # Only singular activations from generated tokens are captured, as these
         # represent the entire context of the input sequence as well
-        if activation_np.shape[1] == 1:
-            # print("Singular activation being triggered!")
-            # We reshape the activation
-            reshaped_activation = activation_np.reshape(1, 3072)
-            # Now we can add this reshaped activation inside of the batched_activations list
-
-            batched_activations.append(reshaped_activation[0].tolist())
-            activations_count = activations_count + 1
-
-            # print("Activation stored in batched_activations. Batched Activations: ", np.array(batched_activations).shape)
-
-        if len(batched_activations) >= 10:
-            # print("There are currently 10 or more batched activations.")
-            tsne = TSNE(n_components=3, perplexity=5, random_state=42)
-            tsne_result = tsne.fit_transform(np.array(batched_activations))
-            # print("tSNE Result: ", tsne_result)
-
-            # Ensure all values are floats
-            tsne_result = tsne_result.astype(float).tolist()
-
-            # Convert tSNE results to the desired JSON format
-            json_results = [
-                {"x": sample[0], "y": sample[1], "z": sample[2], "layer_name": name}
-                for sample in tsne_result
-            ]
-
-            # Convert to JSON string
-            # json_string = json.dumps(json_results, indent=2)
-
-            # Print or send the JSON string
-            # print(json_string)
-
-            # Emit the t-SNE results to the frontend
-            emit('updateTSNEData', json_results, namespace="/", broadcast=True)
-
-            # Once we have the results, we flush the batched_activations array
-            batched_activations = []
-            # print("batched_activations variable has been flushed.")
-    return hook
-
-# Hook function to capture the activation and prepare t-SNE data
-def get_last_activation(name, tokenizer, temperature=0.7, do_sample=True, top_k=50, top_p=0.9):
-    def hook(model, input, output):
-        global predicted_tokens, lm_head_activations_count
-        # print("Retrieving activation from Layer: ", name)
-        output = output[0]  # Ensure we are getting the correct part of the output
-        activation = output.detach().to(torch.float32)
-        activation_np = activation.cpu().numpy()
-
-        if activation_np.shape[0] > 1:
-            print("This activation contains more than 1 elements: ", activation_np, activation_np.shape)
-
-        if activation_np.shape[0] == 1:
-            lm_head_activations_count = lm_head_activations_count + 1
-            # print("Activation retrieved: ", activation_np)
-
-            # Print the shape of the activation
-            # print("Activation shape:", activation_np.shape)
-
-            # Apply temperature scaling
-            scaled_logits = activation / temperature
-
-            # Apply softmax to get probabilities
-            probabilities = F.softmax(scaled_logits, dim=-1)
-
-            # Apply top-k sampling
-            if top_k > 0:
-                top_k_probabilities, top_k_indices = torch.topk(probabilities, top_k, dim=-1)
-            else:
-                top_k_probabilities, top_k_indices = probabilities, torch.arange(probabilities.size(-1))
-
-            # Apply top-p sampling within the top-k probabilities
-            sorted_probabilities, sorted_indices = torch.sort(top_k_probabilities, descending=True)
-            cumulative_probabilities = torch.cumsum(sorted_probabilities, dim=-1)
-            cutoff_index = torch.where(cumulative_probabilities >= top_p)[1][0].item()
-            top_p_indices = sorted_indices[:, :cutoff_index + 1]
-            top_p_probabilities = sorted_probabilities[:, :cutoff_index + 1]
-
-            # Sampling from top-p probabilities
-            if do_sample:
-                chosen_index = torch.multinomial(top_p_probabilities, 1)
-                predicted_token_id = top_k_indices[0, top_p_indices[0, chosen_index]]
-            else:
-                # Choose the token with the highest probability
-                predicted_token_id = top_k_indices[0, top_p_indices[0, 0]]
-
-            token = tokenizer.convert_ids_to_tokens(predicted_token_id.item())
-            predicted_tokens.append(token)
-            print(f"Predicted token ID: {predicted_token_id.item()}, Token: {token}")
+        if not request_context.activation_capture.capture_output(name, output):
+            return
+        request_context.activations_count = request_context.activations_count + 1
 
+        pending_count = request_context.activation_capture.count(name) - request_context.emitted_activations[name]
+        if pending_count >= projection_interval:
+            emit_pending_activations(request_context, name)
     return hook
 
 def load_model_and_tokenizer(model_path):
-    print(f"Loading model from: {model_path}")
+    logger.info(f"Loading model from: {model_path}")
     model = AutoModelForCausalLM.from_pretrained(
         model_path,
         device_map="auto",
@@ -196,76 +157,135 @@ def load_model_and_tokenizer(model_path):
         trust_remote_code=True,
     )
     tokenizer = AutoTokenizer.from_pretrained(model_path)
-    print("Model and tokenizer loaded successfully.")
+    logger.info("Model and tokenizer loaded successfully.")
     return model, tokenizer
 
-def run_inference(model, tokenizer, input_text):
-    global batched_activations, hook_handles, activations_count, lm_head_activations_count, predicted_tokens
-
-    # Unregister existing hooks
-    for handle in hook_handles:
-        handle.remove()
-
-    hook_handles = []
-    predicted_tokens = []
-    batched_activations = []
-    activations_count = 0
-    lm_head_activations_count = 0
-
-    print(f"Running inference for input text: {input_text}")
+session_lock = threading.Lock()
+
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            model, tokenizer = load_model_and_tokenizer("microsoft/Phi-3-mini-4k-instruct")
+            session = InferenceSession(
+                model,
+                tokenizer,
+                activation_layers,
+                get_activation,
+                generation_args,
+                activation_dtype,
+                max_concurrency=max_concurrent_generations,
+            )
+    return session
+
+# Prefilled KV state of recent prompts, shared across requests for the HF model
+prefix_cache = PrefixCache(max_bytes=int(os.getenv('PREFIX_CACHE_MAX_MB', '512')) * 1024 ** 2)
+
+def prefill_prompt(model, tokenizer, messages):
+    # Tokenize exactly as the text-generation pipeline does for chat input
+    with timed('tokenization'):
+        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+    token_ids = input_ids[0].tolist()
+
+    # Everything but the last prompt token is prefilled here; generate() runs the last one
+    prefix_length, kv_cache = prefix_cache.lookup(token_ids[:-1])
+    cache_lookups.inc(cache='prefix', result='miss' if kv_cache is None else 'hit')
+    if kv_cache is None:
+        kv_cache = DynamicCache()
+    if prefix_length < len(token_ids) - 1:
+        with timed('prefill'), torch.no_grad():
+            model(input_ids[:, prefix_length:-1].to(model.device), past_key_values=kv_cache, use_cache=True)
+        prefix_cache.store(token_ids[:-1], kv_cache)
+    logger.debug(f"Reused {prefix_length} of {len(token_ids)} prompt tokens from the prefix cache.")
+    return kv_cache
+
+def prepare_inference(session, request_context, input_text):
+    logger.debug("Running inference", **log_fields(input_text=input_text))
 
     messages = [
         {"role": "user", "content": input_text},
     ]
 
-    for module in model.named_modules():
-        module_name = module[0]
-        print(module_name)
-        print(module)
-
-    # Register hooks for a layer
-    layer_name = 'model.layers.31'
-    layer = dict([*model.named_modules()])[layer_name]
-    hook_handle = layer.register_forward_hook(get_activation(layer_name))
-    hook_handles.append(hook_handle)
-
-    # Register hook for last layer
-    last_layer_name = 'lm_head'
-    last_layer = dict([*model.named_modules()])[last_layer_name]
-    last_hook_handle = last_layer.register_forward_hook(get_last_activation(last_layer_name, tokenizer))
-    hook_handles.append(last_hook_handle)
-
-    # for module in model.named_modules():
-    #     module_name = module[0]
-    #     print(module)
-        # if "model.layers." in module_name and module_name.count('.') == 2:
-        #     layer = dict([*model.named_modules()])[module_name]
-        #     layer.register_forward_hook(get_activation(module_name))
-        #     print("Hook attached to layer: ", module_name)
-
-    pipe = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-    )
+    # Prefill runs outside the request's activation scope so only generated tokens are captured
+    kv_cache = prefill_prompt(session.model, session.tokenizer, messages)
+
+    # Sampling happens once, in the shared sampler driven by generate() itself
+    request_context.sampling_processor = SamplingLogitsProcessor(temperature=0.7, top_k=50, top_p=0.9)
 
-    generation_args = {
-        "max_new_tokens": 50,  # Limit to a smaller number for testing
-        "return_full_text": False,
-        "temperature": 0.7,
-        "do_sample": True,
-        "top_k": 50,
-        "top_p": 0.9,
+    request_generation_args = {
+        **session.generation_args,
+        "logits_processor": LogitsProcessorList([request_context.sampling_processor]),
+        "past_key_values": kv_cache,
     }
 
-    output = pipe(messages, **generation_args)
+    return messages, request_generation_args
+
+def record_predicted_tokens(request_context, tokenizer):
+    token_ids = request_context.sampling_processor.token_ids()
+    request_context.predicted_tokens = tokenizer.convert_ids_to_tokens(token_ids)
+    request_context.lm_head_activations_count = len(token_ids)
+    tokens_generated.inc(len(token_ids), model='phi3_hf')
+
+def run_inference(session, request_context, input_text):
+    messages, request_generation_args = prepare_inference(session, request_context, input_text)
+
+    with session.activate(request_context), timed('decode'):
+        output = session.pipe(messages, **request_generation_args)
+    record_predicted_tokens(request_context, session.tokenizer)
 
-    print("output: ", output)
+    logger.debug("Pipeline output", **log_fields(output=output))
 
     generated_text = output[0]['generated_text']
 
     return generated_text
 
+def generate_tokens(session, request_context, input_text):
+    messages, request_generation_args = prepare_inference(session, request_context, input_text)
+    streamer = TextIteratorStreamer(session.tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+    # Generation runs on its own thread while decoded text is consumed from the streamer here;
+    # the request context is copied so the activation hooks can still emit to Socket.IO
+    generation_errors = []
+
+    @copy_current_request_context
+    def generate():
+        try:
+            with session.activate(request_context), timed('decode'):
+                session.pipe(messages, streamer=streamer, **request_generation_args)
+            record_predicted_tokens(request_context, session.tokenizer)
+            # Send the activations of the last, partial projection interval
+            for layer_name in activation_layers:
+                emit_pending_activations(request_context, layer_name)
+        except Exception as e:
+            generation_errors.append(e)
+        finally:
+            # Always end the stream, or the consumer below would wait for tokens forever
+            streamer.end()
+
+    thread = threading.Thread(target=generate)
+    thread.start()
+    try:
+        yield from streamer
+    finally:
+        thread.join()
+    if generation_errors:
+        raise generation_errors[0]
+
+def stream_inference(input_text):
+    def tokens():
+        session = get_session()
+        with session.request() as request_context:
+            yield from generate_tokens(session, request_context, input_text)
+
+    # Session errors surface through stream_events like generation errors do
+    return stream_events(tokens())
+
+def stream_inference_endpoint():
+    data = request.json
+    input_text = data.get('input_text', '')
+    logger.debug("Received input text for streaming", **log_fields(input_text=input_text))
+    return sse_response(stream_inference(input_text))
+
 def truncate_text(text):
     last_period = text.rfind('.')
     last_exclamation = text.rfind('!')
@@ -278,61 +298,41 @@ def truncate_text(text):
 
 def run_inference_endpoint():
     try:
-        global model, tokenizer, predicted_tokens, batched_activations
         data = request.json
         input_text = data.get('input_text', '')
-        print(f"Received input text: {input_text}")
-
-        if model is None or tokenizer is None:
-            model_path = "microsoft/Phi-3-mini-4k-instruct"
-            model, tokenizer = load_model_and_tokenizer(model_path)
-        
-        generated_text = run_inference(model, tokenizer, input_text)
-
-        # print("There are currently 10 or more batched activations.")
-        tsne = TSNE(n_components=3, perplexity=round(len(batched_activations)/2), random_state=42)
-        tsne_result = tsne.fit_transform(np.array(batched_activations))
-        # print("tSNE Result: ", tsne_result)
-
-        # Ensure all values are floats
-        tsne_result = tsne_result.astype(float).tolist()
+        logger.debug("Received input text", **log_fields(input_text=input_text))
 
-        # Convert tSNE results to the desired JSON format
-        json_results = [
-            {"x": sample[0], "y": sample[1], "z": sample[2], "layer_name": "model.layers.31"}
-            for sample in tsne_result
-        ]
+        session = get_session()
+        with session.request() as request_context:
+            generated_text = run_inference(session, request_context, input_text)
 
-        # Convert to JSON string
-        json_string = json.dumps(json_results, indent=2)
+            # Send any activations not yet projected
+            for layer_name in activation_layers:
+                json_results = emit_pending_activations(request_context, layer_name)
+                logger.debug(f"Sent last {len(json_results)} projected activations for {layer_name}.")
 
-        # Print or send the JSON string
-        print("sending last batch of activations: ", json_string)
-
-        # Emit the t-SNE results to the frontend
-        emit('updateTSNEData', json_results, namespace="/", broadcast=True)
+        predicted_tokens = request_context.predicted_tokens
 
         # Emitting the predicted tokens here too
         emit('updatePredictedTokensData', predicted_tokens, namespace="/", broadcast=True)
 
-        batched_activations = []
-
-        print("Generated text:", generated_text)
-
-        # Tokenize the generated text
-        tokens = tokenizer.tokenize(generated_text)
-        print("Predicted Tokens:", predicted_tokens)
-        print("Predicted Tokens length: ", len(predicted_tokens))
-        print("Tokenized text:", tokens)
-        print("Tokenized text length: ", len(tokens))
-        print("Activations count is: ", activations_count)
-        print("LM Activations count is: ", lm_head_activations_count)
+        # Token-level dumps are only built when someone is reading them
+        if logger.isEnabledFor(logging.DEBUG):
+            tokens = session.tokenizer.tokenize(generated_text)
+            logger.debug("Generated text", **log_fields(
+                output=generated_text,
+                predicted_tokens=predicted_tokens,
+                predicted_tokens_length=len(predicted_tokens),
+                tokenized_text=tokens,
+                tokenized_text_length=len(tokens),
+                activations_count=request_context.activations_count,
+                lm_head_activations_count=request_context.lm_head_activations_count,
+            ))
 
         # Truncate the generated text before returning it
         generated_text = truncate_text(generated_text)
 
         return jsonify({'success': True, 'output': generated_text})
     except Exception as e:
-        print(f"Error during inference: {e}")
-        traceback.print_exc()
+        logger.exception(f"Error during inference: {e}")
         return jsonify({'success': False, 'message': 'Internal server error.'}), 500
@@ -0,0 +1,98 @@
+import queue
+import threading
+from contextlib import contextmanager
+from transformers import pipeline
+from activation_capture import ActivationCapture
+
+
+class RequestContext:
+    """
+    State owned by a single generation request: its activation buffer, tokens and counters.
+    """
+
+    def __init__(self, activation_capture, layer_names):
+        self.activation_capture = activation_capture
+        self.emitted_activations = {name: 0 for name in layer_names}
+        self.predicted_tokens = []
+        self.activations_count = 0
+        self.lm_head_activations_count = 0
+        self.sampling_processor = None
+
+
+class InferenceSession:
+    """
+    Everything about a loaded Hugging Face model that does not change between requests.
+
+    Built once at model load: the module index, the text-generation pipeline, the base
+    generation arguments, the forward hooks and a pool of activation capture buffers.
+    The hooks stay attached for the lifetime of the session and route each call to the
+    RequestContext active on the calling thread, so overlapping requests never see each
+    other's activations. At most max_concurrency requests run on the model at once.
+    """
+
+    def __init__(self, model, tokenizer, hook_layer_names, hook_factory, generation_args, activation_dtype, max_concurrency=1):
+        """
+        Initialize the session.
+
+        :param model: Loaded causal LM
+        :param tokenizer: Tokenizer matching the model
+        :param hook_layer_names: Names of the modules whose activations are captured
+        :param hook_factory: Callable taking a layer name and returning hook(request_context, module, input, output)
+        :param generation_args: Base arguments passed to the pipeline on every request
+        :param activation_dtype: Storage dtype of the activation capture buffers
+        :param max_concurrency: Maximum number of requests generating at the same time
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.modules = dict(model.named_modules())
+        self.hook_layer_names = list(hook_layer_names)
+        self.pipe = pipeline("text-generation", model=model, tokenizer=tokenizer)
+        self.generation_args = generation_args
+        self._active = threading.local()
+        self._gate = threading.BoundedSemaphore(max_concurrency)
+
+        # One preallocated capture buffer per concurrent request
+        self._captures = queue.Queue()
+        for _ in range(max_concurrency):
+            self._captures.put(ActivationCapture(
+                self.hook_layer_names,
+                generation_args["max_new_tokens"],
+                model.config.hidden_size,
+                dtype=activation_dtype,
+            ))
+
+        self.hook_handles = [
+            self.modules[layer_name].register_forward_hook(self._dispatch(hook_factory(layer_name)))
+            for layer_name in self.hook_layer_names
+        ]
+
+    def _dispatch(self, hook):
+        def dispatch(module, input, output):
+            request_context = getattr(self._active, 'request_context', None)
+            if request_context is not None:
+                hook(request_context, module, input, output)
+        return dispatch
+
+    @contextmanager
+    def request(self):
+        """
+        Wait for a free slot on the model and yield a fresh RequestContext.
+        """
+        with self._gate:
+            activation_capture = self._captures.get()
+            activation_capture.reset()
+            try:
+                yield RequestContext(activation_capture, self.hook_layer_names)
+            finally:
+                self._captures.put(activation_capture)
+
+    @contextmanager
+    def activate(self, request_context):
+        """
+        Route hook calls made on the current thread to request_context.
+        """
+        self._active.request_context = request_context
+        try:
+            yield
+        finally:
+            self._active.request_context = None
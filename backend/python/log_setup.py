@@ -0,0 +1,97 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+# Log level for the Python backend and opt-in, sampled token-level tracing
+log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+token_trace_enabled = os.getenv('TOKEN_TRACE') == "true"
+token_trace_sample_rate = float(os.getenv('TOKEN_TRACE_SAMPLE_RATE', '0.01'))
+
+listener = None
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with any structured fields passed through log_fields().
+    """
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class JsonQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that keeps the traceback as a separate field.
+
+    The stock prepare() formats the record and folds the traceback into its message.
+    Here only the message arguments are merged, and the traceback is kept in exc_text
+    so JsonFormatter still writes it as the exc_info field.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+def configure_logging():
+    """
+    Route all logging through a queue drained by a background listener thread.
+
+    Request threads only enqueue records; formatting and stdout writes happen on the
+    listener, so slow terminals or log collectors never stall generation.
+    """
+    global listener
+    if listener is not None:
+        return
+
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [JsonQueueHandler(log_queue)]
+    root.setLevel(log_level)
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """
+    Flush queued records; call before exiting without running atexit handlers.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+def log_fields(**fields):
+    """
+    Keyword arguments attaching structured fields to a log call: logger.info(msg, **log_fields(k=v)).
+    """
+    return {'extra': {'fields': fields}}
+
+def trace_token(logger, **fields):
+    """
+    Log a generated token at DEBUG level when token tracing is on, for a sample of tokens.
+    """
+    if token_trace_enabled and random.random() < token_trace_sample_rate:
+        logger.debug("Generated token", **log_fields(**fields))
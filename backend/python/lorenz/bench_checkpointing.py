@@ -0,0 +1,71 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+import torch.nn as nn
+from checkpointing import CheckpointedGPT
+
+# Peak memory against step time for each activation checkpointing policy. Every policy
+# runs in a fresh process so peak RSS on CPU is not carried over from the previous one.
+
+def peak_memory_bytes(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run_policy(args, checkpoint_every, memory_budget_bytes, results):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    model = CheckpointedGPT(
+        args.vocab_size, args.n_embd, args.n_layer, args.n_head,
+        checkpoint_every=checkpoint_every,
+        memory_budget_bytes=memory_budget_bytes,
+    ).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = nn.CrossEntropyLoss()
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_length), device=device)
+    target_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_length), device=device)
+
+    def step():
+        optimizer.zero_grad()
+        loss = criterion(model(input_ids).view(-1, args.vocab_size), target_ids.view(-1))
+        loss.backward()
+        optimizer.step()
+        return loss.item()
+
+    step()  # Warm up allocator and optimizer state
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    step_time = (time.perf_counter() - start) / args.steps
+    checkpointed = sorted(model.checkpointed_layers(args.batch_size, args.seq_length))
+    results.put((peak_memory_bytes(device), step_time, checkpointed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark per-layer activation checkpointing policies.")
+    parser.add_argument("--vocab-size", type=int, default=50257)
+    parser.add_argument("--n-embd", type=int, default=512)
+    parser.add_argument("--n-layer", type=int, default=8)
+    parser.add_argument("--n-head", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--seq-length", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--budget-mb", type=float, nargs="*", default=[256, 512], help="Memory budgets to try")
+    args = parser.parse_args()
+
+    policies = [("none", 0, None)]
+    policies += [(f"every {k}", k, None) for k in (4, 2, 1)]
+    policies += [(f"budget {mb:.0f} MB", 1, mb * 1024 ** 2) for mb in args.budget_mb]
+
+    context = multiprocessing.get_context("spawn")
+    print(f"batch {args.batch_size} x {args.seq_length} tokens, n_embd {args.n_embd}, n_layer {args.n_layer}")
+    for name, checkpoint_every, memory_budget_bytes in policies:
+        results = context.Queue()
+        process = context.Process(target=run_policy, args=(args, checkpoint_every, memory_budget_bytes, results))
+        process.start()
+        peak, step_time, checkpointed = results.get()
+        process.join()
+        print(f"{name:>16}: peak {peak / 1024 ** 2:8.1f} MB, {step_time * 1e3:8.1f} ms per step, checkpointed layers {checkpointed}")
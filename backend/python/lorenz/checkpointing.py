@@ -0,0 +1,74 @@
+import math
+import torch
+from torch.utils.checkpoint import checkpoint
+from lorenz import GPT
+
+def layer_activation_bytes(layer, batch_size, seq_length, n_head, element_size=4):
+    """
+    Rough size of the activations one nn.TransformerEncoderLayer keeps for backward.
+
+    Counts the attention projections, the (seq x seq) attention probabilities and their
+    dropout mask, the feed-forward hidden states and the norm inputs.
+    """
+    tokens = batch_size * seq_length
+    n_embd = layer.linear1.in_features
+    dim_feedforward = layer.linear1.out_features
+    attention = 2 * batch_size * n_head * seq_length * seq_length
+    return (tokens * (9 * n_embd + 3 * dim_feedforward) + attention) * element_size
+
+class CheckpointedGPT(GPT):
+    """
+    GPT that recomputes selected transformer layers during backward instead of storing their activations.
+
+    By default every checkpoint_every-th layer is checkpointed. With memory_budget_bytes
+    set, the layers are chosen per batch instead: as few as possible, evenly spaced, so
+    that the estimated activation memory of the transformer layers fits the budget.
+    """
+
+    def __init__(self, vocab_size, n_embd, n_layer, n_head, checkpoint_every=1, memory_budget_bytes=None):
+        """
+        Initialize the model.
+
+        :param checkpoint_every: Checkpoint layers 0, k, 2k, ...; 0 disables checkpointing
+        :param memory_budget_bytes: Optional activation budget that overrides checkpoint_every
+        """
+        super(CheckpointedGPT, self).__init__(vocab_size, n_embd, n_layer, n_head)
+        self.checkpoint_every = checkpoint_every
+        self.memory_budget_bytes = memory_budget_bytes
+
+    def checkpointed_layers(self, batch_size, seq_length):
+        """
+        Indices of the layers to checkpoint for a batch of the given shape.
+        """
+        n_layer = len(self.transformer_layers)
+        if self.memory_budget_bytes is None:
+            if self.checkpoint_every <= 0:
+                return set()
+            return set(range(0, n_layer, self.checkpoint_every))
+
+        element_size = self.embedding.weight.element_size()
+        full = layer_activation_bytes(self.transformer_layers[0], batch_size, seq_length, self.n_head, element_size)
+        if full * n_layer <= self.memory_budget_bytes:
+            return set()
+        # A checkpointed layer keeps only its input, plus one layer's activations live while it is recomputed
+        kept = batch_size * seq_length * self.n_embd * element_size
+        num_checkpointed = math.ceil((full * n_layer + full - self.memory_budget_bytes) / (full - kept))
+        num_checkpointed = min(n_layer, max(1, num_checkpointed))
+        return {int(i * n_layer / num_checkpointed) for i in range(num_checkpointed)}
+
+    def forward(self, x, attention_mask=None):
+        assert x.dtype in [torch.int64, torch.int32], "Input to embedding layer must be integer type"
+        src_mask, src_key_padding_mask = self.attention_masks(x, attention_mask)
+        # Nothing is stored for backward outside training, so nothing needs checkpointing
+        checkpointed = self.checkpointed_layers(*x.shape) if self.training and torch.is_grad_enabled() else set()
+
+        x = self.embedding(x)
+        x = x.float()  # Convert to float after embedding if necessary
+        for layer_idx, layer in enumerate(self.transformer_layers):
+            if layer_idx in checkpointed:
+                x = checkpoint(layer, x, src_mask, src_key_padding_mask, use_reentrant=False)  # Explicitly set use_reentrant
+            else:
+                x = layer(x, src_mask=src_mask, src_key_padding_mask=src_key_padding_mask)
+        x = self.ln_f(x)
+        logits = self.head(x)
+        return logits
@@ -0,0 +1,191 @@
+import json
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+def token_dtype(vocab_size):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+def corpus_paths(prefix):
+    return prefix + '.bin', prefix + '.idx.npy', prefix + '.json'
+
+def build_token_corpus(texts, tokenizer, prefix, chunk_size=1024, source=None):
+    """
+    Tokenize texts once into a flat token file plus an offsets index.
+
+    Texts are tokenized and appended chunk by chunk, so the corpus never has to fit in
+    memory. Sequence i occupies tokens offsets[i]:offsets[i + 1] of the token file.
+
+    :param texts: Iterable of strings
+    :param tokenizer: Hugging Face tokenizer used for encoding
+    :param prefix: Path prefix of the .bin, .idx.npy and .json files to write
+    :param chunk_size: Number of texts tokenized per batch
+    :param source: JSON-serializable description of the texts, stored so stale corpora can be detected
+    :return: Number of sequences written
+    """
+    tokens_path, offsets_path, meta_path = corpus_paths(prefix)
+    dtype = token_dtype(len(tokenizer))
+    offsets = [0]
+
+    def flush(chunk, tokens_file):
+        for token_ids in tokenizer(chunk, add_special_tokens=True)['input_ids']:
+            np.asarray(token_ids, dtype=dtype).tofile(tokens_file)
+            offsets.append(offsets[-1] + len(token_ids))
+
+    with open(tokens_path, 'wb') as tokens_file:
+        chunk = []
+        for text in texts:
+            chunk.append(text)
+            if len(chunk) == chunk_size:
+                flush(chunk, tokens_file)
+                chunk = []
+        if chunk:
+            flush(chunk, tokens_file)
+
+    np.save(offsets_path, np.asarray(offsets, dtype=np.int64))
+    with open(meta_path, 'w') as meta_file:
+        json.dump({'dtype': np.dtype(dtype).name, 'num_sequences': len(offsets) - 1, 'num_tokens': offsets[-1], 'source': source}, meta_file)
+    return len(offsets) - 1
+
+class TokenCorpusDataset(Dataset):
+    """
+    Sequences of a corpus written by build_token_corpus, read from a memory map.
+
+    Items are numpy views into the mapped token file; nothing is copied until the batch
+    is collated. The map is opened lazily so each DataLoader worker maps the file itself
+    instead of receiving a pickled copy.
+    """
+
+    def __init__(self, prefix):
+        self.tokens_path, offsets_path, meta_path = corpus_paths(prefix)
+        with open(meta_path, 'r') as meta_file:
+            meta = json.load(meta_file)
+        self.dtype = np.dtype(meta['dtype'])
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        self.tokens = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tokens'] = None
+        state['offsets'] = np.asarray(self.offsets)
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if self.tokens is None:
+            self.tokens = np.memmap(self.tokens_path, dtype=self.dtype, mode='r')
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+def collate_tokens(batch, pad_token_id):
+    """
+    Pad a batch of token id arrays and split it into next-token inputs and targets.
+
+    All rows are scattered into the padded array in one indexed write.
+
+    :return: (inputs, targets) long tensors of shape (batch, longest - 1)
+    """
+    lengths = np.fromiter((len(seq) for seq in batch), dtype=np.int64, count=len(batch))
+    padded = np.full((len(batch), max(int(lengths.max()), 2)), pad_token_id, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    rows = np.repeat(np.arange(len(batch)), lengths)
+    cols = np.arange(int(lengths.sum())) - np.repeat(starts, lengths)
+    padded[rows, cols] = np.concatenate(batch)
+
+    padded = torch.from_numpy(padded)
+    return padded[:, :-1].contiguous(), padded[:, 1:].contiguous()
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups sequences of similar length to cut padding.
+
+    Each epoch the indices are shuffled and split into pools of pool_batches batches;
+    every pool is sorted by length and cut into batches, and the batch order is shuffled
+    again. Batches hold batch_size sequences, or, when max_tokens is set, as many
+    sequences as fit in max_tokens once padded to the longest of them.
+
+    For data-parallel training every rank builds the same batch list from the shared
+    seed and takes every world_size-th batch, trimmed so all ranks run the same number
+    of steps.
+    """
+
+    def __init__(self, lengths, batch_size=8, max_tokens=None, pool_batches=100, shuffle=True, seed=0, rank=0, world_size=1):
+        """
+        Initialize the sampler.
+
+        :param lengths: Sequence lengths, indexed like the dataset
+        :param batch_size: Sequences per batch when max_tokens is not set
+        :param max_tokens: Optional padded-token budget per batch
+        :param pool_batches: Number of batches' worth of sequences sorted together
+        :param shuffle: Shuffle sequences and batches each epoch
+        :param seed: Base seed, combined with the epoch set through set_epoch()
+        :param rank: Rank of this process in data-parallel training
+        :param world_size: Number of data-parallel processes
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_size = pool_batches * batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def _split(self, pool):
+        if self.max_tokens is None:
+            return [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        # Sorted ascending, so the sequence being added is always the longest in its batch
+        batches = []
+        start = 0
+        for end in range(1, len(pool) + 1):
+            if end - start > 1 and (end - start) * self.lengths[pool[end - 1]] > self.max_tokens:
+                batches.append(pool[start:end - 1])
+                start = end - 1
+        batches.append(pool[start:])
+        return batches
+
+    def batches(self):
+        if self._batches is None:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+            batches = []
+            for start in range(0, len(indices), self.pool_size):
+                pool = indices[start:start + self.pool_size]
+                pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+                batches.extend(self._split(pool))
+            if self.shuffle:
+                batches = [batches[i] for i in rng.permutation(len(batches))]
+            batches = [batch for batch in batches if len(batch)]
+            num_steps = len(batches) // self.world_size
+            self._batches = [batch.tolist() for batch in batches[self.rank::self.world_size][:num_steps]]
+        return self._batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self._batches = None
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches())
+
+def corpus_exists(prefix, source=None):
+    """
+    Whether a corpus has been built at prefix, from the given source when one is passed.
+    """
+    if not all(os.path.exists(path) for path in corpus_paths(prefix)):
+        return False
+    if source is None:
+        return True
+    with open(corpus_paths(prefix)[2], 'r') as meta_file:
+        return json.load(meta_file).get('source') == source
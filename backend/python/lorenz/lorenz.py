@@ -1,50 +1,68 @@
 import torch
 import torch.nn as nn
-from torch.nn.functional import softmax
+import torch.nn.functional as F
 import json
+import mmap
 import os
+import struct
+import sys
+import zlib
 from transformers import GPT2Tokenizer
 
-def pad_sequence(batch, pad_token_id):
-    inputs = []
-    targets = []
+# Sampling is shared with the inference server, one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sampling import sample_next_tokens
 
-    for item in batch:
-        input_seq, target_seq = item
-        if input_seq is None or target_seq is None:
-            raise ValueError(f"Found None in batch item: {item}")
-        inputs.append(input_seq.tolist())
-        targets.append(target_seq.tolist())
+def sample_top_p(logits, top_p=0.9, special_token_ids=None):
+    """
+    Nucleus sampling over the last dimension of logits, using the serving sampler.
 
-    max_length = max(len(seq) for seq in inputs)
+    :param logits: Tensor of shape (..., vocab_size)
+    :param top_p: Cumulative probability mass kept before sampling
+    :param special_token_ids: Token ids that are never sampled
+    :return: Tensor of shape (..., 1) holding the sampled token ids
+    """
+    next_tokens = sample_next_tokens(logits.reshape(-1, logits.size(-1)), top_p=top_p, banned_token_ids=special_token_ids)
+    return next_tokens.reshape(*logits.shape[:-1], 1)
 
-    padded_inputs = [seq + [pad_token_id] * (max_length - len(seq)) for seq in inputs]
-    padded_targets = [seq + [pad_token_id] * (max_length - len(seq)) for seq in targets]
+def top_p_sampling(logits, top_p=0.9, special_token_ids=None):
+    return sample_top_p(logits, top_p, special_token_ids).item()
 
-    padded_inputs_tensor = torch.tensor(padded_inputs, dtype=torch.long)
-    padded_targets_tensor = torch.tensor(padded_targets, dtype=torch.long)
+def mask_positions(query_length, key_length, device=None):
+    # Positions of the last query_length queries and of every key, shaped to broadcast
+    query_positions = torch.arange(key_length - query_length, key_length, device=device)
+    key_positions = torch.arange(key_length, device=device)
+    return query_positions[:, None], key_positions[None, :]
 
-    return padded_inputs_tensor, padded_targets_tensor
+def causal_mask(query_length, key_length, device=None):
+    """
+    Boolean mask of shape (query_length, key_length), True where a query may attend.
 
-def top_p_sampling(logits, top_p=0.9, special_token_ids=None):
-    if special_token_ids is None:
-        special_token_ids = []
+    The queries are the last query_length positions of a key_length long sequence.
+    """
+    query_positions, key_positions = mask_positions(query_length, key_length, device)
+    return key_positions <= query_positions
 
-    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-    cumulative_probs = torch.cumsum(softmax(sorted_logits, dim=-1), dim=-1)
+class KVCache:
+    """
+    Preallocated per-layer key/value buffers for incremental decoding.
 
-    # Remove tokens with cumulative probability above the threshold
-    sorted_indices_to_remove = cumulative_probs > top_p
-    sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-    sorted_indices_to_remove[..., 0] = 0
+    Buffers have shape (batch, n_head, max_length, head_dim); length is the number of
+    positions already written, shared by every layer.
+    """
 
-    # Remove special tokens from sampling
-    for token_id in special_token_ids:
-        logits[token_id] = -float('Inf')
+    def __init__(self, n_layer, batch_size, n_head, max_length, head_dim, device=None, dtype=None):
+        shape = (batch_size, n_head, max_length, head_dim)
+        self.keys = [torch.empty(shape, device=device, dtype=dtype) for _ in range(n_layer)]
+        self.values = [torch.empty(shape, device=device, dtype=dtype) for _ in range(n_layer)]
+        self.length = 0
 
-    probabilities = softmax(logits, dim=-1)
-    next_token = torch.multinomial(probabilities, 1)
-    return next_token.item()
+    def update(self, layer_idx, key, value):
+        # Write this step's keys and values and return everything cached so far
+        end = self.length + key.size(2)
+        self.keys[layer_idx][:, :, self.length:end] = key
+        self.values[layer_idx][:, :, self.length:end] = value
+        return self.keys[layer_idx][:, :, :end], self.values[layer_idx][:, :, :end]
 
 class GPT(nn.Module):
     """
@@ -63,36 +81,224 @@ class GPT(nn.Module):
         :param n_head: Number of attention heads
         """
         super(GPT, self).__init__()
+        self.vocab_size = vocab_size
+        self.n_embd = n_embd
+        self.n_layer = n_layer
+        self.n_head = n_head
         self.embedding = nn.Embedding(vocab_size, n_embd)
         self.transformer_layers = nn.ModuleList([
-            nn.TransformerEncoderLayer(d_model=n_embd, nhead=n_head)
+            nn.TransformerEncoderLayer(d_model=n_embd, nhead=n_head, batch_first=True)
             for _ in range(n_layer)
         ])
         self.ln_f = nn.LayerNorm(n_embd)
         self.head = nn.Linear(n_embd, vocab_size)
 
-    def forward(self, x):
+    def attention_masks(self, x, attention_mask=None):
+        """
+        Build the causal mask and key padding mask for a (batch, seq) input.
+
+        :param attention_mask: Optional (batch, seq) tensor, 1 for real tokens and 0 for padding
+        :return: (src_mask, src_key_padding_mask) in the convention of nn.TransformerEncoderLayer
+        """
+        seq_length = x.size(1)
+        src_mask = ~causal_mask(seq_length, seq_length, device=x.device)
+        src_key_padding_mask = None if attention_mask is None else attention_mask == 0
+        return src_mask, src_key_padding_mask
+
+    def forward(self, x, attention_mask=None):
+        src_mask, src_key_padding_mask = self.attention_masks(x, attention_mask)
         x = self.embedding(x)
         for layer in self.transformer_layers:
-            x = layer(x)
+            x = layer(x, src_mask=src_mask, src_key_padding_mask=src_key_padding_mask)
         x = self.ln_f(x)
         logits = self.head(x)
         return logits
 
-def load_model(model_path, vocab_size, n_embd, n_layer, n_head):
+    def _attention_step(self, layer, layer_idx, x, kv_cache, attn_mask):
+        # Same projections as nn.MultiheadAttention, with past keys and values read from the cache
+        self_attn = layer.self_attn
+        batch_size, step_length, _ = x.shape
+        head_dim = self.n_embd // self.n_head
+        qkv = F.linear(x, self_attn.in_proj_weight, self_attn.in_proj_bias)
+        query, key, value = (
+            t.view(batch_size, step_length, self.n_head, head_dim).transpose(1, 2)
+            for t in qkv.chunk(3, dim=-1)
+        )
+        key, value = kv_cache.update(layer_idx, key, value)
+        attended = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask)
+        attended = attended.transpose(1, 2).reshape(batch_size, step_length, self.n_embd)
+        return self_attn.out_proj(attended)
+
+    def _layer_step(self, layer, layer_idx, x, kv_cache, attn_mask):
+        # Mirrors nn.TransformerEncoderLayer.forward in eval mode, where dropout is a no-op
+        def feed_forward(h):
+            return layer.linear2(layer.activation(layer.linear1(h)))
+
+        if layer.norm_first:
+            x = x + self._attention_step(layer, layer_idx, layer.norm1(x), kv_cache, attn_mask)
+            return x + feed_forward(layer.norm2(x))
+        x = layer.norm1(x + self._attention_step(layer, layer_idx, x, kv_cache, attn_mask))
+        return layer.norm2(x + feed_forward(x))
+
+    def forward_step(self, input_ids, kv_cache, key_mask):
+        """
+        Run only the new positions through the model, attending to everything in kv_cache.
+
+        :param input_ids: (batch, step_length) tensor of new token ids
+        :param kv_cache: KVCache holding the keys and values of earlier positions
+        :param key_mask: (batch, total_length) bool tensor, True for real tokens, covering cached and new positions
+        :return: Logits of shape (batch, step_length, vocab_size)
+        """
+        step_length = input_ids.size(1)
+        total_length = kv_cache.length + step_length
+        query_positions, key_positions = mask_positions(step_length, total_length, device=input_ids.device)
+        allowed = key_positions <= query_positions
+        # Every position may attend to itself, so fully padded rows never softmax over nothing
+        own_position = key_positions == query_positions
+        attn_mask = (allowed & key_mask[:, None, :]) | own_position
+        attn_mask = attn_mask[:, None, :, :]
+
+        x = self.embedding(input_ids)
+        for layer_idx, layer in enumerate(self.transformer_layers):
+            x = self._layer_step(layer, layer_idx, x, kv_cache, attn_mask)
+        kv_cache.length = total_length
+        return self.head(self.ln_f(x))
+
+    @torch.no_grad()
+    def generate(self, input_ids, max_new_tokens, attention_mask=None, top_p=0.9, temperature=1.0,
+                 special_token_ids=None, eos_token_id=None):
+        """
+        Autoregressively sample new tokens with a key/value cache.
+
+        The prompt is encoded in one pass; every later step runs the layers on a single
+        new position per sequence. Batched prompts must be left padded, with padding
+        marked by zeros in attention_mask.
+
+        :param input_ids: (batch, prompt_length) tensor of prompt token ids
+        :param max_new_tokens: Maximum number of tokens to generate per sequence
+        :param attention_mask: Optional (batch, prompt_length) tensor, 1 for real tokens and 0 for padding
+        :param top_p: Nucleus sampling threshold passed to top_p_sampling
+        :param temperature: Logits are divided by this before sampling
+        :param special_token_ids: Token ids that are never sampled
+        :param eos_token_id: Sequences stop once they produce this token
+        :return: (batch, generated_length) tensor of new token ids, eos_token_id after a sequence ends
+        """
+        was_training = self.training
+        self.eval()
+        batch_size, prompt_length = input_ids.shape
+        device = input_ids.device
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        # Room for the prompt plus every generated token, allocated once
+        key_mask = torch.zeros(batch_size, prompt_length + max_new_tokens, dtype=torch.bool, device=device)
+        key_mask[:, :prompt_length] = attention_mask.bool()
+        kv_cache = KVCache(
+            self.n_layer, batch_size, self.n_head, prompt_length + max_new_tokens,
+            self.n_embd // self.n_head, device=device, dtype=self.embedding.weight.dtype,
+        )
+        # The sampled token of an ended sequence must not be one that top_p_sampling excludes
+        if special_token_ids and eos_token_id in special_token_ids:
+            special_token_ids = [t for t in special_token_ids if t != eos_token_id]
+
+        generated = []
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        logits = self.forward_step(input_ids, kv_cache, key_mask[:, :prompt_length])[:, -1]
+        for step in range(max_new_tokens):
+            next_tokens = sample_top_p(logits / temperature, top_p, special_token_ids).squeeze(-1)
+            if eos_token_id is not None:
+                next_tokens = next_tokens.masked_fill(finished, eos_token_id)
+                finished |= next_tokens == eos_token_id
+            generated.append(next_tokens)
+            if bool(finished.all()) or step == max_new_tokens - 1:
+                break
+            key_mask[:, kv_cache.length] = True
+            logits = self.forward_step(next_tokens[:, None], kv_cache, key_mask[:, :kv_cache.length + 1])[:, -1]
+
+        self.train(was_training)
+        return torch.stack(generated, dim=1)
+
+# Checkpoints use the safetensors layout: an 8-byte little-endian header length, a JSON
+# header of tensor dtypes, shapes and byte ranges, then the raw tensor bytes
+checkpoint_dtypes = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+checkpoint_dtype_names = {name: dtype for dtype, name in checkpoint_dtypes.items()}
+
+class CheckpointError(Exception):
+    """
+    Raised when a checkpoint file is malformed or fails its checksum.
+    """
+
+def model_hyperparameters(model):
+    return {'vocab_size': model.vocab_size, 'n_embd': model.n_embd, 'n_layer': model.n_layer, 'n_head': model.n_head}
+
+def tensor_bytes(tensor):
+    # Raw bytes of a contiguous CPU tensor as a uint8 array sharing its memory
+    return tensor.reshape(-1).view(torch.uint8).numpy()
+
+def read_checkpoint_header(checkpoint_file):
+    header_length = struct.unpack('<Q', checkpoint_file.read(8))[0]
+    header = json.loads(checkpoint_file.read(header_length))
+    return header, 8 + header_length
+
+def is_legacy_checkpoint(model_path):
+    # torch.save writes zip archives, which start with a local file header
+    with open(model_path, 'rb') as checkpoint_file:
+        return checkpoint_file.read(2) == b'PK'
+
+def load_model(model_path, vocab_size=None, n_embd=None, n_layer=None, n_head=None, verify=True):
     """
     Load the model from a file if it exists.
 
+    Tensors are memory-mapped copy-on-write straight into a model built on the meta device,
+    so no random weights are allocated and processes loading the same file share its pages.
+    The hyperparameters are read from the file; the arguments are only needed for a new
+    model or for checkpoints written with torch.save.
+
     :param model_path: Path to the model file
     :param vocab_size: Size of the vocabulary
     :param n_embd: Dimensionality of the embeddings
     :param n_layer: Number of transformer layers
     :param n_head: Number of attention heads
-    :return: Loaded model or None if file doesn't exist
+    :param verify: Check every tensor against its stored CRC32, which reads the whole file
+    :return: Loaded model, or a newly initialized one if the file doesn't exist
     """
-    model = GPT(vocab_size, n_embd, n_layer, n_head)
-    if os.path.exists(model_path):
+    if not os.path.exists(model_path):
+        return GPT(vocab_size, n_embd, n_layer, n_head)
+    if is_legacy_checkpoint(model_path):
+        model = GPT(vocab_size, n_embd, n_layer, n_head)
         model.load_state_dict(torch.load(model_path))
+        return model
+
+    with open(model_path, 'rb') as checkpoint_file:
+        header, data_start = read_checkpoint_header(checkpoint_file)
+        # ACCESS_COPY maps the file privately: reads share the page cache, writes stay local
+        mapped = mmap.mmap(checkpoint_file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    metadata = header.pop('__metadata__', {})
+    hyperparameters = json.loads(metadata['hyperparameters'])
+    checksums = json.loads(metadata.get('checksums', '{}'))
+    file_bytes = torch.frombuffer(mapped, dtype=torch.uint8)
+
+    state_dict = {}
+    for name, entry in header.items():
+        start, end = (data_start + offset for offset in entry['data_offsets'])
+        if verify and zlib.crc32(memoryview(mapped)[start:end]) != checksums.get(name):
+            raise CheckpointError(f"Checksum mismatch for {name} in {model_path}")
+        dtype = checkpoint_dtype_names[entry['dtype']]
+        state_dict[name] = file_bytes[start:end].view(dtype).reshape(entry['shape'])
+
+    with torch.device('meta'):
+        model = GPT(**hyperparameters)
+    model.load_state_dict(state_dict, assign=True)
     return model
 
 def save_model(model, model_path):
@@ -102,7 +308,38 @@ def save_model(model, model_path):
     :param model: Model to save
     :param model_path: Path to save the model
     """
-    torch.save(model.state_dict(), model_path)
+    state_dict = {name: tensor.detach().cpu().contiguous() for name, tensor in model.state_dict().items()}
+    # Widest dtypes first keep every tensor aligned to its element size without padding
+    names = sorted(state_dict, key=lambda name: -state_dict[name].element_size())
+
+    header = {}
+    checksums = {}
+    offset = 0
+    for name in names:
+        tensor = state_dict[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            'dtype': checkpoint_dtypes[tensor.dtype],
+            'shape': list(tensor.shape),
+            'data_offsets': [offset, offset + nbytes],
+        }
+        checksums[name] = zlib.crc32(tensor_bytes(tensor))
+        offset += nbytes
+    header['__metadata__'] = {
+        'format': 'pt',
+        'hyperparameters': json.dumps(model_hyperparameters(model)),
+        'checksums': json.dumps(checksums),
+    }
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # Pad the header so the tensor data starts 8-byte aligned
+    header_bytes += b' ' * (-(8 + len(header_bytes)) % 8)
+    with open(model_path + '.tmp', 'wb') as checkpoint_file:
+        checkpoint_file.write(struct.pack('<Q', len(header_bytes)))
+        checkpoint_file.write(header_bytes)
+        for name in names:
+            checkpoint_file.write(tensor_bytes(state_dict[name]))
+    os.replace(model_path + '.tmp', model_path)
 
 def load_vocab(file_path):
     with open(file_path, 'r') as f:
@@ -110,18 +347,27 @@ def load_vocab(file_path):
     print(f"Loaded vocabulary of size: {len(vocab)}")
     return vocab
 
-def run_inference(model, input_text):
-    tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
-    tokenized_input = tokenizer.encode(input_text, return_tensors='pt')
+def run_inference(model, input_text, max_new_tokens=50, top_p=0.9):
+    """
+    Generate a continuation for one prompt, or for a list of prompts in one batch.
 
-    # Perform inference
-    model.eval()
-    with torch.no_grad():
-        output = model(tokenized_input)
+    :return: The decoded continuation, or a list of them when input_text is a list
+    """
+    tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = 'left'  # Keeps the last prompt token of every row in the same column
+    prompts = [input_text] if isinstance(input_text, str) else list(input_text)
+    encoded = tokenizer(prompts, return_tensors='pt', padding=True)
 
-    # Get the most likely tokens
-    predicted_token_ids = torch.argmax(output, dim=-1)
+    device = next(model.parameters()).device
+    generated_ids = model.generate(
+        encoded['input_ids'].to(device),
+        max_new_tokens,
+        attention_mask=encoded['attention_mask'].to(device),
+        top_p=top_p,
+        eos_token_id=tokenizer.eos_token_id,
+    )
 
-    # Decode the predicted tokens to a string
-    decoded_output = tokenizer.decode(predicted_token_ids[0], skip_special_tokens=True)
-    return decoded_output
+    # Decode the generated tokens to strings
+    decoded_outputs = [tokenizer.decode(token_ids, skip_special_tokens=True) for token_ids in generated_ids]
+    return decoded_outputs[0] if isinstance(input_text, str) else decoded_outputs
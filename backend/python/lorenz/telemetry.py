@@ -0,0 +1,128 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import torch
+
+def current_rss_bytes():
+    # Current resident set size, only available where /proc is
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def peak_rss_bytes():
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def memory_stats(device):
+    """
+    Memory figures for the training device: CUDA allocator stats on GPU, process RSS otherwise.
+
+    The current RSS is reported as rss_gb; without /proc, the peak RSS is reported as peak_rss_gb.
+    """
+    rss = current_rss_bytes()
+    if rss is not None:
+        stats = {"rss_gb": rss / (1024 ** 3)}
+    else:
+        stats = {"peak_rss_gb": peak_rss_bytes() / (1024 ** 3)}
+    if device.type == 'cuda':
+        reserved = torch.cuda.memory_reserved(device)
+        stats.update({
+            "allocated_memory_gb": torch.cuda.memory_allocated(device) / (1024 ** 3),
+            "reserved_memory_gb": reserved / (1024 ** 3),
+            "free_memory_gb": (torch.cuda.get_device_properties(device).total_memory - reserved) / (1024 ** 3),
+        })
+    return stats
+
+class TrainingTelemetry:
+    """
+    Append-only JSONL training telemetry written by a background thread.
+
+    The training loop only times its steps and, every sample_every steps, puts one record
+    on a queue; serializing and writing happen on the writer thread. If the writer falls
+    behind, records are dropped rather than stalling training.
+    """
+
+    _stop = object()
+
+    def __init__(self, path, device, sample_every=10, max_pending=1024):
+        """
+        Initialize the telemetry sink and start its writer thread.
+
+        :param path: JSONL file that records are appended to
+        :param device: torch.device being trained on
+        :param sample_every: Write one record per this many steps
+        :param max_pending: Maximum number of records waiting for the writer
+        """
+        self.path = path
+        self.device = device
+        self.sample_every = max(1, sample_every)
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._write, name="training-telemetry", daemon=True)
+        self._thread.start()
+        self._steps = 0
+        self._tokens = 0
+        self._step_time = 0.0
+        self._data_wait_time = 0.0
+
+    def _write(self):
+        with open(self.path, 'a') as log_file:
+            while True:
+                record = self._queue.get()
+                if record is self._stop:
+                    break
+                log_file.write(json.dumps(record) + "\n")
+                if self._queue.empty():
+                    log_file.flush()
+
+    def record_step(self, epoch, batch_idx, total_batches, batch_size, num_tokens, data_wait_time, step_time, **fields):
+        """
+        Account for one training step and emit a record when the sampling interval is reached.
+
+        Throughput figures are averaged over the steps since the previous record.
+        """
+        self._steps += 1
+        self._tokens += num_tokens
+        self._step_time += step_time
+        self._data_wait_time += data_wait_time
+        if self._steps < self.sample_every:
+            return
+
+        elapsed = self._step_time + self._data_wait_time
+        record = {
+            "time": time.time(),
+            "epoch": epoch,
+            "batch_idx": batch_idx + 1,
+            "total_batches": total_batches,
+            "batch_size": batch_size,
+            "tokens_per_sec": self._tokens / elapsed if elapsed > 0 else 0.0,
+            "step_time_ms": 1000 * self._step_time / self._steps,
+            "data_wait_ms": 1000 * self._data_wait_time / self._steps,
+            **memory_stats(self.device),
+            **fields,
+        }
+        self._steps = 0
+        self._tokens = 0
+        self._step_time = 0.0
+        self._data_wait_time = 0.0
+        self.write(record)
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Write any pending records and stop the writer thread.
+        """
+        self._queue.put(self._stop)
+        self._thread.join()
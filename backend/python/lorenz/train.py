@@ -1,15 +1,23 @@
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch.cuda.amp import autocast, GradScaler
-from torch.utils.data import DataLoader, Dataset
-from torch.utils.checkpoint import checkpoint
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
 from transformers import GPT2Tokenizer
-import json
+import argparse
 import os
+import time
 import nltk
-from lorenz import GPT, save_model, pad_sequence
+from contextlib import nullcontext
+from functools import partial
+from lorenz import save_model
+from checkpointing import CheckpointedGPT
+from corpus import LengthBucketBatchSampler, TokenCorpusDataset, build_token_corpus, collate_tokens, corpus_exists
+from telemetry import TrainingTelemetry, memory_stats
 from tqdm import tqdm
 from nltk.corpus import reuters
 
@@ -17,15 +25,6 @@ from nltk.corpus import reuters
 tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
 tokenizer.pad_token = tokenizer.eos_token  # Set the pad token to the end-of-text token
 
-# Save vocabulary function is no longer needed since we use the tokenizer directly
-# log_file_path and other initial setup remains the same
-
-log_file_path = "gpu_usage_log.json"
-
-# Initialize the log file
-with open(log_file_path, 'w') as log_file:
-    json.dump([], log_file)  # Create an empty JSON array
-
 # Ensure the reuters corpus is downloaded
 nltk.download('reuters')
 
@@ -45,122 +44,186 @@ def sample_size_in_bytes(average_length, token_size=4):
 def total_dataset_size_in_bytes(num_samples, average_sample_size):
     return num_samples * average_sample_size
 
-def print_gpu_memory():
-    allocated = torch.cuda.memory_allocated() / (1024 ** 3)
-    reserved = torch.cuda.memory_reserved() / (1024 ** 3)
-    free = torch.cuda.get_device_properties(0).total_memory / (1024 ** 3) - reserved
-    print(f"Allocated Memory: {allocated:.2f} GB")
-    print(f"Reserved Memory: {reserved:.2f} GB")
-    print(f"Free Memory: {free:.2f} GB")
-
-def log_gpu_usage(epoch, batch_idx, len_dataloader, input_ids_size, allocated, reserved, free):
-    log_entry = {
+def print_memory_usage(device):
+    for name, value in memory_stats(device).items():
+        print(f"{name}: {value:.2f}")
+
+def save_training_state(path, model, optimizer, scheduler, scaler, epoch):
+    # Written to a temporary file first so an interrupted save never leaves a truncated state
+    state = {
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "scaler": scaler.state_dict(),
         "epoch": epoch,
-        "batch_idx": batch_idx + 1,
-        "total_batches": len_dataloader,
-        "batch_size": input_ids_size,
-        "allocated_memory_gb": allocated,
-        "reserved_memory_gb": reserved,
-        "free_memory_gb": free
     }
-    
-    # Append the log entry to the JSON file
-    with open(log_file_path, 'r+') as log_file:
-        logs = json.load(log_file)
-        logs.append(log_entry)
-        log_file.seek(0)
-        json.dump(logs, log_file, indent=4)
-
-class CheckpointedGPT(GPT):
-    def forward(self, x):
-        assert x.dtype in [torch.int64, torch.int32], "Input to embedding layer must be integer type"
-        return checkpoint(self._forward_impl, x, use_reentrant=False)  # Explicitly set use_reentrant
-
-    def _forward_impl(self, x):
-        x = self.embedding(x)
-        x = x.float()  # Convert to float after embedding if necessary
-        for layer in self.transformer_layers:
-            x = layer(x)
-        x = self.ln_f(x)
-        logits = self.head(x)
-        return logits
-
-class SimpleDataset(Dataset):
-    def __init__(self, data, tokenizer):
-        self.data = [tokenizer.encode(seq, add_special_tokens=True) for seq in data]
-        self.tokenizer = tokenizer
-
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        input_seq = self.data[idx]
-        target_seq = input_seq.copy()  # For simplicity, target is the same as input
-        return torch.tensor(input_seq), torch.tensor(target_seq)
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_training_state(path, rank=0, world_size=1):
+    """
+    Read a state written by save_training_state on rank 0 and share it with every rank.
+
+    Only rank 0 writes the file, so on other nodes it may not exist; every rank resumes
+    from rank 0's copy, or none does.
+
+    :return: The state, or None when rank 0 has no saved state
+    """
+    state = torch.load(path, map_location="cpu") if rank == 0 and os.path.exists(path) else None
+    if world_size > 1:
+        shared = [state]
+        dist.broadcast_object_list(shared, src=0)
+        state = shared[0]
+    return state
+
+def restore_training_state(state, model, optimizer, scheduler, scaler):
+    """
+    Restore a state returned by load_training_state.
+
+    :return: The epoch to resume from
+    """
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    scheduler.load_state_dict(state["scheduler"])
+    scaler.load_state_dict(state["scaler"])
+    return state["epoch"] + 1
 
 # Training function
-def train_model(model, dataset, epochs, batch_size, lr):
+def train_model(model, dataset, device, epochs, batch_size, lr, num_workers=2, telemetry_path="training_telemetry.jsonl", telemetry_every=10, max_tokens=None,
+                accumulate_steps=1, rank=0, world_size=1, model_path="./models/lorenz_model.pth", state_path="./models/lorenz_train_state.pth", resume=False):
+    """
+    Train the model with length-bucketed batches, optionally data parallel.
+
+    With world_size > 1 the process group must already be initialized; each rank trains
+    on its own shard of the batches and gradients are averaged across ranks. Only rank 0
+    writes checkpoints.
+
+    :param batch_size: Sequences per batch when max_tokens is not set
+    :param max_tokens: Optional padded-token budget per batch, replacing the fixed batch size
+    :param accumulate_steps: Number of batches whose gradients are summed before each optimizer step
+    :param state_path: Optimizer, scheduler and model state saved every epoch for resuming
+    :param resume: Continue from state_path when it exists
+    """
     pad_token_id = tokenizer.pad_token_id
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=lambda batch: pad_sequence(batch, pad_token_id))
+    batch_sampler = LengthBucketBatchSampler(dataset.lengths(), batch_size=batch_size, max_tokens=max_tokens, rank=rank, world_size=world_size)
+    dataloader = DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=partial(collate_tokens, pad_token_id=pad_token_id),
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        pin_memory=device.type == 'cuda',
+    )
     
     optimizer = optim.Adam(model.parameters(), lr=lr)
-    scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=5, verbose=True)
-    criterion = nn.CrossEntropyLoss()
-    scaler = GradScaler()
+    scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=5, verbose=rank == 0)
+    # Padded targets carry no signal; the pad token is eos, which the corpus never contains
+    criterion = nn.CrossEntropyLoss(ignore_index=pad_token_id)
+    # Mixed precision only applies on CUDA; on CPU both are explicitly off
+    use_amp = device.type == 'cuda'
+    scaler = GradScaler(enabled=use_amp)
+
+    start_epoch = 0
+    state = load_training_state(state_path, rank, world_size) if resume else None
+    if state is not None:
+        start_epoch = restore_training_state(state, model, optimizer, scheduler, scaler)
+        if rank == 0:
+            print(f"Resuming from epoch {start_epoch + 1}.")
+
+    # Every rank starts from rank 0's weights and all-reduces gradients after backward
+    train_module = DistributedDataParallel(model) if world_size > 1 else model
+    if world_size > 1:
+        telemetry_path = f"{os.path.splitext(telemetry_path)[0]}.rank{rank}.jsonl"
+    telemetry = TrainingTelemetry(telemetry_path, device, sample_every=telemetry_every)
 
     model.train()
-    print(f"Total size of the dataset: {len(dataset)} samples")
+    if rank == 0:
+        print(f"Total size of the dataset: {len(dataset)} samples")
 
     if len(dataloader) == 0:
         print("Dataloader is empty.")
+        telemetry.close()
         return
 
-    for epoch in range(epochs):
-        print(f"Starting epoch {epoch+1}/{epochs}")
+    for epoch in range(start_epoch, epochs):
+        if rank == 0:
+            print(f"Starting epoch {epoch+1}/{epochs}")
         epoch_loss = 0
-        progress_bar = tqdm(enumerate(dataloader), total=len(dataloader), desc=f"Epoch [{epoch+1}/{epochs}]")
+        real_tokens = 0
+        padded_tokens = 0
+        batch_sampler.set_epoch(epoch)
+        num_batches = len(dataloader)
+        progress_bar = tqdm(enumerate(dataloader), total=num_batches, desc=f"Epoch [{epoch+1}/{epochs}]", disable=rank != 0)
+        optimizer.zero_grad()
+        data_start = time.perf_counter()
         for batch_idx, (input_ids, target_ids) in progress_bar:
-            input_ids, target_ids = input_ids.to(device), target_ids.to(device)
-            
-            optimizer.zero_grad()
-            with autocast():
-                outputs = model(input_ids)
-                loss = criterion(outputs.view(-1, model.head.out_features), target_ids.view(-1))
-
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
-
-            progress_bar.set_postfix(loss=loss.item())
-
-            epoch_loss += loss.item()
-
-            allocated = torch.cuda.memory_allocated() / (1024 ** 3)
-            reserved = torch.cuda.memory_reserved() / (1024 ** 3)
-            free = torch.cuda.get_device_properties(0).total_memory / (1024 ** 3) - reserved
-            log_gpu_usage(epoch, batch_idx, len(dataloader), input_ids.size(0), allocated, reserved, free)
-        
-        avg_epoch_loss = epoch_loss / len(dataloader)
-        print(f"Epoch [{epoch+1}/{epochs}] completed. Average Loss: {avg_epoch_loss:.4f}")
+            step_start = time.perf_counter()
+            # Counted on the host copy, before the transfer, to avoid a device sync
+            num_real_tokens = int((target_ids != pad_token_id).sum())
+            real_tokens += num_real_tokens
+            padded_tokens += target_ids.numel()
+            input_ids, target_ids = input_ids.to(device, non_blocking=True), target_ids.to(device, non_blocking=True)
+
+            # Gradients are only synchronized across ranks on the batch that steps the optimizer
+            step_optimizer = (batch_idx + 1) % accumulate_steps == 0 or batch_idx + 1 == num_batches
+            sync_context = train_module.no_sync() if world_size > 1 and not step_optimizer else nullcontext()
+            with sync_context:
+                with autocast(enabled=use_amp):
+                    outputs = train_module(input_ids)
+                    loss = criterion(outputs.view(-1, model.head.out_features), target_ids.view(-1))
+                scaler.scale(loss / accumulate_steps).backward()
+
+            if step_optimizer:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+
+            # item() waits for the device, so the step time covers the whole step
+            loss_value = loss.item()
+            progress_bar.set_postfix(loss=loss_value)
+
+            epoch_loss += loss_value
+
+            telemetry.record_step(
+                epoch, batch_idx, num_batches, input_ids.size(0), num_real_tokens,
+                data_wait_time=step_start - data_start,
+                step_time=time.perf_counter() - step_start,
+                loss=loss_value,
+            )
+            data_start = time.perf_counter()
+
+        epoch_stats = [epoch_loss, num_batches, real_tokens, padded_tokens]
+        if world_size > 1:
+            # Every rank steps the scheduler with the same global loss
+            epoch_stats_tensor = torch.tensor(epoch_stats, dtype=torch.float64)
+            dist.all_reduce(epoch_stats_tensor)
+            epoch_stats = epoch_stats_tensor.tolist()
+        epoch_loss, num_batches, real_tokens, padded_tokens = epoch_stats
+
+        avg_epoch_loss = epoch_loss / num_batches
+        padding_efficiency = real_tokens / padded_tokens if padded_tokens else 0.0
+        if rank == 0:
+            print(f"Epoch [{epoch+1}/{epochs}] completed. Average Loss: {avg_epoch_loss:.4f}, Padding Efficiency: {padding_efficiency:.2%}")
+        telemetry.write({"epoch": epoch, "epoch_loss": avg_epoch_loss, "padding_efficiency": padding_efficiency})
 
         # Step the scheduler with the validation loss (avg_epoch_loss)
         scheduler.step(avg_epoch_loss)
 
-    save_model(model, "./models/lorenz_model.pth")
-    print("Model saved successfully.")
-
-if __name__ == "__main__":
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    vocab_size = tokenizer.vocab_size
+        if rank == 0:
+            save_training_state(state_path, model, optimizer, scheduler, scaler, epoch)
 
-    n_embd = 512
-    n_layer = 8
-    n_head = 16
+    telemetry.close()
+    if rank == 0:
+        save_model(model, model_path)
+        print("Model saved successfully.")
 
-    model = CheckpointedGPT(vocab_size, n_embd, n_layer, n_head).to(device)
+def corpus_source(num_sentences):
+    # Everything that decides the corpus contents; a mismatch triggers a rebuild
+    return {'dataset': 'reuters', 'num_sentences': num_sentences, 'tokenizer': tokenizer.name_or_path}
 
+def prepare_corpus(corpus_prefix, num_sentences):
     sentences = reuters.sents()
-    tokenized_sentences = [" ".join(sent) for sent in sentences[:2000]]
+    tokenized_sentences = [" ".join(sent) for sent in sentences[:num_sentences]]
 
     avg_length = average_sentence_length(tokenized_sentences)
     print(f"Average Sentence Length: {avg_length:.2f} tokens")
@@ -170,8 +233,86 @@ if __name__ == "__main__":
 
     total_size = total_dataset_size_in_bytes(len(tokenized_sentences), sample_size)
     print(f"Total Dataset Size: {total_size / (1024 ** 2):.2f} MB")
-    
-    dataset = SimpleDataset(tokenized_sentences, tokenizer)
-    print(f"Total size of the dataset: {len(dataset)} samples")
 
-    train_model(model, dataset, epochs=5, batch_size=8, lr=0.001)
+    # Token ids are written once and memory-mapped by every run and DataLoader worker after that
+    os.makedirs(os.path.dirname(corpus_prefix), exist_ok=True)
+    build_token_corpus(tokenized_sentences, tokenizer, corpus_prefix, source=corpus_source(num_sentences))
+
+def train_worker(rank, world_size, args):
+    """
+    Entry point of one training process, launched directly, by torchrun or by mp.spawn.
+    """
+    if world_size > 1:
+        # Data-parallel training targets CPU nodes, so gradients are reduced over gloo
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+        # Split the cores between the ranks instead of letting each rank use all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // int(os.environ.get("LOCAL_WORLD_SIZE", world_size))))
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    try:
+        # The first process on each node builds the corpus, or rebuilds it when it came
+        # from different settings; the others wait for it
+        if int(os.environ.get("LOCAL_RANK", rank)) == 0 and not corpus_exists(args.corpus_prefix, corpus_source(args.num_sentences)):
+            prepare_corpus(args.corpus_prefix, args.num_sentences)
+        if world_size > 1:
+            dist.barrier()
+
+        dataset = TokenCorpusDataset(args.corpus_prefix)
+        model = CheckpointedGPT(
+            tokenizer.vocab_size, args.n_embd, args.n_layer, args.n_head,
+            checkpoint_every=args.checkpoint_every,
+            memory_budget_bytes=args.activation_budget_mb * 1024 ** 2 if args.activation_budget_mb else None,
+        ).to(device)
+        train_model(
+            model,
+            dataset,
+            device,
+            epochs=args.epochs,
+            batch_size=args.batch_size,
+            lr=args.lr,
+            num_workers=args.num_workers,
+            telemetry_every=args.telemetry_every,
+            max_tokens=args.max_tokens,
+            accumulate_steps=args.accumulate_steps,
+            rank=rank,
+            world_size=world_size,
+            resume=args.resume,
+        )
+    finally:
+        if world_size > 1:
+            dist.destroy_process_group()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the Lorenz GPT model.")
+    parser.add_argument("--nproc", type=int, default=1, help="Data-parallel processes to spawn on this machine.")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=None, help="Padded-token budget per batch instead of a fixed batch size.")
+    parser.add_argument("--accumulate-steps", type=int, default=1, help="Batches per optimizer step.")
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--num-workers", type=int, default=2, help="DataLoader workers per process.")
+    parser.add_argument("--telemetry-every", type=int, default=10, help="Steps per telemetry record.")
+    parser.add_argument("--n-embd", type=int, default=512)
+    parser.add_argument("--n-layer", type=int, default=8)
+    parser.add_argument("--n-head", type=int, default=16)
+    parser.add_argument("--checkpoint-every", type=int, default=1, help="Recompute every k-th layer in backward; 0 disables checkpointing.")
+    parser.add_argument("--activation-budget-mb", type=float, default=None, help="Pick checkpointed layers per batch to fit this activation budget.")
+    parser.add_argument("--num-sentences", type=int, default=2000)
+    parser.add_argument("--corpus-prefix", default="./data/reuters_gpt2")
+    parser.add_argument("--resume", action="store_true", help="Continue from the last saved training state.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if "WORLD_SIZE" in os.environ:
+        # Launched by torchrun, which sets the rank and rendezvous variables
+        train_worker(int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"]), args)
+    elif args.nproc > 1:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        mp.spawn(train_worker, args=(args.nproc, args), nprocs=args.nproc)
+    else:
+        train_worker(0, 1, args)
@@ -0,0 +1,179 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from sub-millisecond cache hits to multi-second generations
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, key)} {value}")
+        return lines
+
+class Gauge:
+    """
+    A gauge whose value is read from a callback at scrape time.
+    """
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning(f"Error collecting gauge {self.name}: {e}")
+            return lines
+        # A callback returns a number, or a dict of label dicts to numbers
+        if isinstance(values, dict):
+            for labels, value in values.items():
+                lines.append(f"{self.name}{format_labels([name for name, _ in labels], [v for _, v in labels])} {value}")
+        else:
+            lines.append(f"{self.name} {values}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {count}")
+        return lines
+
+registry = []
+registry_lock = threading.Lock()
+
+def register(metric):
+    with registry_lock:
+        registry.append(metric)
+    return metric
+
+def render():
+    """
+    Render every registered metric in the Prometheus text exposition format.
+    """
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+stage_seconds = register(Histogram('isari_stage_seconds', 'Time spent in each processing stage.', ('stage',)))
+request_seconds = register(Histogram('isari_request_seconds', 'End-to-end request latency per endpoint.', ('endpoint', 'status')))
+tokens_generated = register(Counter('isari_tokens_generated_total', 'Tokens generated.', ('model',)))
+cache_lookups = register(Counter('isari_cache_lookups_total', 'Cache lookups by cache and result.', ('cache', 'result')))
+
+@contextmanager
+def timed(stage):
+    """
+    Record the duration of the enclosed block under the given stage name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+def process_rss_bytes():
+    # Resident set size from /proc, falling back to the peak RSS elsewhere
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+register(Gauge('isari_process_resident_memory_bytes', 'Resident memory of the server process, models included.', process_rss_bytes))
+
+# Per-request profiling, enabled with PROFILING_ENABLED=true and requested with ?profile=1
+profiling_enabled = os.getenv('PROFILING_ENABLED') == "true"
+profile_dir = os.getenv('PROFILE_DIR', 'profiles')
+
+@contextmanager
+def profiled(name):
+    """
+    Profile the enclosed block and write the report to profile_dir.
+
+    Uses the pyinstrument sampling profiler when it is installed, cProfile otherwise.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    path_prefix = os.path.join(profile_dir, f"{name}-{int(time.time() * 1000)}")
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+
+    if Profiler is not None:
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path_prefix + '.html', 'w') as report:
+                report.write(profiler.output_html())
+            logger.info(f"Profile written to {path_prefix}.html")
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path_prefix + '.prof')
+            logger.info(f"Profile written to {path_prefix}.prof")
@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Collects single-sample inference calls from concurrent requests into batched calls.
+
+    A background thread waits for the first queued sample, then keeps collecting for up to
+    max_wait_ms or until max_batch_size samples are queued. It runs predict_batch once on
+    the stacked batch and resolves each caller's future with its own row of the output.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=16, max_wait_ms=5):
+        """
+        Initialize the batcher.
+
+        :param predict_batch: Callable mapping a [n, ...] array to a [n, ...] array
+        :param max_batch_size: Maximum number of samples per batched call
+        :param max_wait_ms: Longest time the first sample of a batch waits for company
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batch_size_counts = {}
+        self.batches = 0
+        self.samples = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def submit(self, sample):
+        """
+        Queue a single sample and return a Future resolving to its prediction.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((sample, future, time.perf_counter()))
+        return future
+
+    def predict(self, sample, timeout=None):
+        return self.submit(sample).result(timeout=timeout)
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started_at = time.perf_counter()
+            self._record(len(batch), [started_at - enqueued_at for _, _, enqueued_at in batch])
+            try:
+                outputs = self.predict_batch(np.stack([sample for sample, _, _ in batch]))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for i, (_, future, _) in enumerate(batch):
+                future.set_result(outputs[i])
+
+    def _record(self, batch_size, queue_waits):
+        with self._stats_lock:
+            self.batch_size_counts[batch_size] = self.batch_size_counts.get(batch_size, 0) + 1
+            self.batches += 1
+            self.samples += batch_size
+            self.total_queue_wait += sum(queue_waits)
+            self.max_queue_wait = max(self.max_queue_wait, max(queue_waits))
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "samples": self.samples,
+                "mean_batch_size": self.samples / self.batches if self.batches else 0.0,
+                "batch_size_counts": dict(self.batch_size_counts),
+                "mean_queue_wait": self.total_queue_wait / self.samples if self.samples else 0.0,
+                "max_queue_wait": self.max_queue_wait,
+                "queue_depth": self._queue.qsize(),
+            }
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class ModelEntry:
+    """
+    A model held resident by the registry, together with its tokenizer and bookkeeping.
+    """
+
+    def __init__(self, model_path, model, tokenizer, load_time):
+        self.model_path = model_path
+        self.model = model
+        self.tokenizer = tokenizer
+        self.load_time = load_time
+        self.ref_count = 0
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of loaded models keyed by model path.
+
+    Models are loaded once and kept resident. Entries that are in use are reference
+    counted and never evicted; when more than max_models are resident the least
+    recently used idle entry is dropped.
+    """
+
+    def __init__(self, loader, max_models=1):
+        """
+        Initialize the registry.
+
+        :param loader: Callable taking a model path and returning a (model, tokenizer) tuple
+        :param max_models: Maximum number of idle models kept resident
+        """
+        self.loader = loader
+        self.max_models = max_models
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_load_time = 0.0
+
+    def _load(self, model_path, acquire=False):
+        # Only one thread loads a given path; the others wait for its result.
+        # With acquire, the reference is taken under the same lock that makes the entry
+        # visible, so eviction can never drop it first.
+        with self._lock:
+            entry = self._entries.get(model_path)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(model_path)
+                if acquire:
+                    entry.ref_count += 1
+                return entry
+            event = self._loading.get(model_path)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                self._loading[model_path] = event
+                self.misses += 1
+
+        if not owner:
+            event.wait()
+            return self._load(model_path, acquire)
+
+        try:
+            start = time.perf_counter()
+            model, tokenizer = self.loader(model_path)
+            load_time = time.perf_counter() - start
+            entry = ModelEntry(model_path, model, tokenizer, load_time)
+            with self._lock:
+                self.total_load_time += load_time
+                self._entries[model_path] = entry
+                if acquire:
+                    entry.ref_count += 1
+                # The new entry stays resident even if every other slot is pinned
+                self._evict(keep=model_path)
+            logger.info(f"Model {model_path} loaded in {load_time:.2f}s.")
+            return entry
+        finally:
+            with self._lock:
+                del self._loading[model_path]
+            event.set()
+
+    def _evict(self, keep=None):
+        # Caller must hold the lock
+        for model_path in list(self._entries):
+            if len(self._entries) <= self.max_models:
+                break
+            if model_path != keep and self._entries[model_path].ref_count == 0:
+                del self._entries[model_path]
+                self.evictions += 1
+                logger.info(f"Evicted model {model_path} from registry.")
+
+    def get(self, model_path):
+        """
+        Return the entry for model_path, loading it if needed, and take a reference on it.
+        """
+        return self._load(model_path, acquire=True)
+
+    def release(self, entry):
+        """
+        Drop a reference taken with get().
+        """
+        with self._lock:
+            entry.ref_count -= 1
+            self._evict()
+
+    @contextmanager
+    def acquire(self, model_path):
+        """
+        Context manager yielding a (model, tokenizer) tuple for model_path.
+        """
+        entry = self.get(model_path)
+        try:
+            yield entry.model, entry.tokenizer
+        finally:
+            self.release(entry)
+
+    def warm_up(self, model_paths):
+        """
+        Load the given models ahead of the first request.
+        """
+        for model_path in model_paths:
+            self._load(model_path)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "resident": {
+                    path: {"ref_count": entry.ref_count, "load_time": entry.load_time}
+                    for path, entry in self._entries.items()
+                },
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "total_load_time": self.total_load_time,
+            }
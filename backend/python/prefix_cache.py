@@ -0,0 +1,131 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from transformers import DynamicCache
+
+
+def hash_tokens(token_ids):
+    return hashlib.sha1(",".join(map(str, token_ids)).encode()).hexdigest()
+
+
+def cache_nbytes(kv_cache):
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in kv_cache.to_legacy_cache()
+    )
+
+
+class PrefixCacheEntry:
+    def __init__(self, token_ids, kv_cache, nbytes):
+        self.token_ids = token_ids
+        self.kv_cache = kv_cache
+        self.nbytes = nbytes
+        self.block_hashes = []
+
+
+class PrefixCache:
+    """
+    LRU cache of prefilled key/value state keyed by token-sequence hashes.
+
+    Each entry holds the KV cache for one prompt prefix. The prefix is indexed at every
+    block_size boundary, so a new prompt that shares only the first few blocks with a
+    cached one (for example the chat template and a system preamble) still reuses that
+    part of the state.
+    """
+
+    def __init__(self, max_bytes, block_size=16):
+        """
+        Initialize the cache.
+
+        :param max_bytes: Memory budget for the stored KV state
+        :param block_size: Token granularity at which prefixes are matched
+        """
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._entries = OrderedDict()
+        self._block_index = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, token_ids):
+        """
+        Return (prefix_length, kv_cache) for the longest cached block-aligned prefix of token_ids.
+
+        The returned KV cache is a private copy cropped to prefix_length that the caller may
+        extend. Returns (0, None) on a miss.
+        """
+        with self._lock:
+            match_length, match_key = 0, None
+            for end in range(self.block_size, len(token_ids) + 1, self.block_size):
+                entry_key = self._block_index.get(hash_tokens(token_ids[:end]))
+                if entry_key is None:
+                    break
+                match_length, match_key = end, entry_key
+
+            if match_key is None:
+                self.misses += 1
+                return 0, None
+
+            self.hits += 1
+            self.reused_tokens += match_length
+            self._entries.move_to_end(match_key)
+            entry = self._entries[match_key]
+
+        # Stored tensors are never modified, so only the matched positions are copied, outside the lock
+        kv_cache = DynamicCache.from_legacy_cache(tuple(
+            (key[:, :, :match_length].clone(), value[:, :, :match_length].clone())
+            for key, value in entry.kv_cache.to_legacy_cache()
+        ))
+        return match_length, kv_cache
+
+    def store(self, token_ids, kv_cache):
+        """
+        Store a copy of the KV state computed for token_ids.
+        """
+        token_ids = list(token_ids)
+        entry_key = hash_tokens(token_ids)
+        nbytes = cache_nbytes(kv_cache)
+        if nbytes > self.max_bytes or len(token_ids) < self.block_size:
+            return
+
+        with self._lock:
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                return
+
+        entry = PrefixCacheEntry(token_ids, copy.deepcopy(kv_cache), nbytes)
+        with self._lock:
+            # A concurrent store of the same prompt may have won while the copy was made
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                return
+            for end in range(self.block_size, len(token_ids) + 1, self.block_size):
+                block_hash = hash_tokens(token_ids[:end])
+                entry.block_hashes.append(block_hash)
+                self._block_index[block_hash] = entry_key
+            self._entries[entry_key] = entry
+            self.nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        # Caller must hold the lock
+        while self.nbytes > self.max_bytes and self._entries:
+            entry_key, entry = self._entries.popitem(last=False)
+            self.nbytes -= entry.nbytes
+            for block_hash in entry.block_hashes:
+                if self._block_index.get(block_hash) == entry_key:
+                    del self._block_index[block_hash]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "nbytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reused_tokens": self.reused_tokens,
+            }
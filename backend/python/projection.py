@@ -0,0 +1,110 @@
+import threading
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+
+
+class IncrementalPCABackend:
+    """
+    Projects activations with an IncrementalPCA that is refined batch by batch.
+    """
+
+    def __init__(self, n_components=3):
+        self.n_components = n_components
+        self.min_fit_samples = n_components
+        self.pca = IncrementalPCA(n_components=n_components)
+        self.is_fitted = False
+
+    def partial_fit(self, x):
+        self.pca.partial_fit(x)
+        self.is_fitted = True
+
+    def transform(self, x):
+        return self.pca.transform(x)
+
+
+class RandomProjectionBackend:
+    """
+    Projects activations with a fixed Gaussian random matrix; needs no fitting at all.
+    """
+
+    def __init__(self, n_components=3, seed=42):
+        self.n_components = n_components
+        self.min_fit_samples = 1
+        self.seed = seed
+        self.components = None
+        self.is_fitted = False
+
+    def partial_fit(self, x):
+        if self.components is None:
+            rng = np.random.default_rng(self.seed)
+            self.components = rng.standard_normal((x.shape[1], self.n_components)) / np.sqrt(x.shape[1])
+        self.is_fitted = True
+
+    def transform(self, x):
+        return x @ self.components
+
+
+projection_backends = {
+    'pca': IncrementalPCABackend,
+    'random': RandomProjectionBackend,
+}
+
+
+class ProjectionEngine:
+    """
+    Streams activations into a 3D space without refitting on every batch.
+
+    New activations are projected into the current fitted space as soon as they arrive.
+    They are also buffered and folded into the fit every refit_every samples. Until the
+    backend has seen enough samples for its first fit, activations are held back and
+    projected together once the fit exists.
+    """
+
+    def __init__(self, backend, refit_every=10):
+        """
+        Initialize the engine.
+
+        :param backend: Projection backend instance (see projection_backends)
+        :param refit_every: Number of new samples folded into the fit at a time
+        """
+        self.backend = backend
+        self.refit_every = refit_every
+        self._unfit = []
+        self._unprojected = []
+        self._lock = threading.Lock()
+
+    def add(self, activations):
+        """
+        Add [n, hidden] activations and return the [m, 3] points that can be emitted now.
+        """
+        # Always copied: callers pass views into the pooled capture ring, which later requests overwrite
+        activations = np.array(activations, dtype=np.float32, copy=True)
+        with self._lock:
+            self._unfit.append(activations)
+            if not self.backend.is_fitted:
+                self._unprojected.append(activations)
+                if sum(len(a) for a in self._unfit) < self.backend.min_fit_samples:
+                    return np.empty((0, self.backend.n_components))
+                self._fit_pending()
+                points = self.backend.transform(np.concatenate(self._unprojected))
+                self._unprojected = []
+                return points
+
+            points = self.backend.transform(activations)
+            if sum(len(a) for a in self._unfit) >= self.refit_every:
+                self._fit_pending()
+            return points
+
+    def _fit_pending(self):
+        # Caller must hold the lock
+        batch = np.concatenate(self._unfit)
+        if len(batch) >= self.backend.min_fit_samples:
+            self.backend.partial_fit(batch)
+            self._unfit = []
+
+
+def to_points(projected, layer_name):
+    return [
+        {"x": float(sample[0]), "y": float(sample[1]), "z": float(sample[2]), "layer_name": layer_name}
+        for sample in projected
+    ]
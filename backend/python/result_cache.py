@@ -0,0 +1,135 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_key(data, model_version):
+    """
+    Cache key for raw upload bytes analyzed by a given model version.
+    """
+    digest = hashlib.sha256(model_version.encode() + b'\0')
+    digest.update(data)  # Hashed in place, so a memoryview of the upload is not copied
+    return digest.hexdigest()
+
+
+class SqliteResultStore:
+    """
+    On-disk result store shared by every server process pointing at the same file.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        # sqlite connections cannot be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key, now):
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT value FROM results WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, expires_at, now):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now),
+            )
+            connection.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            connection.execute(
+                "DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY last_access DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+
+class ResultCache:
+    """
+    TTL + LRU cache of analysis results keyed by content hash.
+
+    An in-process OrderedDict answers repeat submissions without any I/O. When a
+    SqliteResultStore is configured, misses fall through to it and new results are
+    written to it, so processes share each other's hits.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, store=None):
+        """
+        Initialize the cache.
+
+        :param max_entries: Maximum number of results kept in memory
+        :param ttl_seconds: How long a result stays valid
+        :param store: Optional shared store consulted on in-memory misses
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        value = self.store.get(key, now) if self.store is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.shared_hits += 1
+            self._put(key, value, now + self.ttl_seconds)
+        return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._put(key, value, now + self.ttl_seconds)
+        if self.store is not None:
+            self.store.set(key, value, now + self.ttl_seconds, now)
+
+    def _put(self, key, value, expires_at):
+        # Caller must hold the lock
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,103 @@
+import torch
+import torch.nn.functional as F
+from transformers import LogitsProcessor
+
+
+def apply_repetition_penalty(logits, previous_tokens, penalty):
+    """
+    Penalize the logits of tokens already present in previous_tokens ([batch, seq]).
+    """
+    scores = torch.gather(logits, -1, previous_tokens)
+    scores = torch.where(scores < 0, scores * penalty, scores / penalty)
+    return logits.scatter(-1, previous_tokens, scores)
+
+
+def apply_top_k(logits, top_k):
+    if top_k <= 0 or top_k >= logits.size(-1):
+        return logits
+    kth_largest = torch.topk(logits, top_k, dim=-1).values[..., -1:]
+    return logits.masked_fill(logits < kth_largest, -float('Inf'))
+
+
+def apply_top_p(logits, top_p):
+    if top_p >= 1.0:
+        return logits
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+    sorted_probs = F.softmax(sorted_logits, dim=-1)
+    # A token is removed when the tokens ranked above it already cover top_p,
+    # so the token that crosses the threshold is always kept
+    sorted_to_remove = (torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > top_p
+    to_remove = sorted_to_remove.scatter(-1, sorted_indices, sorted_to_remove)
+    return logits.masked_fill(to_remove, -float('Inf'))
+
+
+def sample_next_tokens(
+    logits,
+    temperature=1.0,
+    top_k=0,
+    top_p=1.0,
+    repetition_penalty=1.0,
+    previous_tokens=None,
+    banned_token_ids=None,
+    do_sample=True,
+    generator=None,
+):
+    """
+    Pick the next token for every row of a [batch, vocab] logits tensor.
+
+    Everything stays on the logits' device, so no host synchronization happens here.
+
+    :param logits: Tensor of shape [batch, vocab]
+    :param temperature: Softmax temperature applied before top-k/top-p filtering
+    :param top_k: Keep only the k most likely tokens (0 disables)
+    :param top_p: Keep the smallest set of tokens whose probability reaches top_p (1.0 disables)
+    :param repetition_penalty: Penalty for tokens in previous_tokens (1.0 disables)
+    :param previous_tokens: Tensor of shape [batch, seq] with the tokens generated so far
+    :param banned_token_ids: Token ids that can never be produced (list or tensor)
+    :param do_sample: Sample from the filtered distribution, or take the argmax
+    :param generator: Optional torch.Generator for reproducible sampling
+    :return: Tensor of shape [batch] with the chosen token ids
+    """
+    logits = logits.float()
+
+    if repetition_penalty != 1.0 and previous_tokens is not None:
+        logits = apply_repetition_penalty(logits, previous_tokens, repetition_penalty)
+
+    if banned_token_ids is not None and len(banned_token_ids) > 0:
+        banned_token_ids = torch.as_tensor(banned_token_ids, dtype=torch.long, device=logits.device)
+        logits = logits.index_fill(-1, banned_token_ids, -float('Inf'))
+
+    if not do_sample:
+        return torch.argmax(logits, dim=-1)
+
+    logits = logits / max(temperature, 1e-5)
+    logits = apply_top_k(logits, top_k)
+    logits = apply_top_p(logits, top_p)
+
+    probabilities = F.softmax(logits, dim=-1)
+    return torch.multinomial(probabilities, 1, generator=generator).squeeze(-1)
+
+
+class SamplingLogitsProcessor(LogitsProcessor):
+    """
+    Makes sample_next_tokens the sampler of a Hugging Face generate() call.
+
+    The chosen token keeps a logit of 0 and every other token is set to -inf, so
+    generate() must run with do_sample=False and its greedy step returns our choice.
+    Chosen ids are kept on device until token_ids() is called.
+    """
+
+    def __init__(self, **sampling_args):
+        self.sampling_args = sampling_args
+        self.chosen_tokens = []
+
+    def __call__(self, input_ids, scores):
+        next_tokens = sample_next_tokens(scores, previous_tokens=input_ids, **self.sampling_args)
+        self.chosen_tokens.append(next_tokens)
+        forced_scores = torch.full_like(scores, -float('Inf'))
+        return forced_scores.scatter(-1, next_tokens.unsqueeze(-1), 0.0)
+
+    def token_ids(self, row=0):
+        if not self.chosen_tokens:
+            return []
+        return torch.stack(self.chosen_tokens, dim=-1)[row].tolist()
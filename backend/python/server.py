@@ -1,23 +1,43 @@
-from flask import Flask, request
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv(".env")
+
+# The async worker model has to be patched in before anything else is imported
+import serving
+serving.monkey_patch()
+
+# Structured logging is set up before the modules that log while importing
+import log_setup
+log_setup.configure_logging()
+
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, emit
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from worker_endpoints import analyze_worker_data
-from dotenv import load_dotenv
+from worker_endpoints import InMemoryUploadRequest, analyze_worker_data, deepfake_batcher, max_upload_bytes, result_cache
+import startup
+import metrics
 import logging
 import os
-
-# Load environment variables from .env file
-load_dotenv(".env")
+import sys
+import time
 
 # Check if the environment is production
 isProduction = os.getenv('PYTHON_ENV') == "production"
 cors_allowed_origin = "https://isari.ai" if isProduction else "http://localhost:5000"
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = max_upload_bytes + 1024 ** 2  # Leave room for the form fields
+app.request_class = InMemoryUploadRequest  # Uploads are decoded from memory, never spooled to disk
 CORS(app)  # Enable CORS for all routes
-socketio = SocketIO(app, cors_allowed_origins=cors_allowed_origin)  # Initialize SocketIO with CORS allowed origins
+socketio = SocketIO(
+    app,
+    cors_allowed_origins=cors_allowed_origin,  # Initialize SocketIO with CORS allowed origins
+    async_mode=serving.async_mode,
+    message_queue=serving.message_queue,  # Lets several server processes share Socket.IO rooms
+)
 
 # Configure rate limiting
 limiter = Limiter(
@@ -26,17 +46,42 @@ limiter = Limiter(
     default_limits=["100 per 15 minutes"]
 )
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 @app.before_request
 def log_request_info():
+    serving.request_started()
+    g.counted_in_flight = True
+    g.request_start = time.perf_counter()
     logger.info(f"Request: {request.method} {request.url} from {request.remote_addr}")
 
+    # Opt-in per-request profiling with ?profile=1
+    if metrics.profiling_enabled and request.args.get('profile') == '1':
+        g.profile = metrics.profiled(request.endpoint or 'request')
+        g.profile.__enter__()
+
+@app.after_request
+def record_request_latency(response):
+    if 'request_start' in g:
+        metrics.request_seconds.observe(
+            time.perf_counter() - g.request_start,
+            endpoint=request.endpoint or 'unknown',
+            status=response.status_code,
+        )
+    return response
+
+@app.teardown_request
+def track_request_finished(exception):
+    # Requests rejected before log_request_info ran were never counted
+    if g.pop('counted_in_flight', False):
+        serving.request_finished()
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.__exit__(None, None, None)
+
 @socketio.on('connect')
 def handle_connection():
-    print("User connected.")
+    logger.debug("User connected.")
 
 @app.route('/analyzeWorkerData', methods=['POST'])
 @limiter.limit("100 per 15 minutes")  # Apply rate limit to this endpoint
@@ -44,9 +89,121 @@ def analyze_worker_data_route():
     logger.info(f"Handling analyzeWorkerData request from {request.remote_addr}")
     return analyze_worker_data()
 
+def queue_depths():
+    depths = {(('queue', 'deepfake'),): deepfake_batcher.queue_depth()}
+    # The generation stack is only reported once something has imported it
+    inference_endpoints = sys.modules.get('inference_endpoints')
+    if inference_endpoints is not None:
+        depths[(('queue', 'generation'),)] = inference_endpoints.og_batch_scheduler.queue_depth()
+    return depths
+
+def gpu_memory_bytes():
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available():
+        return 0
+    return torch.cuda.memory_allocated()
+
+def model_registry_stats():
+    # Only available once the generation stack has been imported
+    inference_endpoints = sys.modules.get('inference_endpoints')
+    return inference_endpoints.og_model_registry.stats() if inference_endpoints is not None else None
+
+def model_registry_gauge(key):
+    def collect():
+        stats = model_registry_stats()
+        return {} if stats is None else {(): stats[key]}
+    return collect
+
+def model_load_seconds():
+    stats = model_registry_stats()
+    if stats is None:
+        return {}
+    return {(('model', path),): entry['load_time'] for path, entry in stats['resident'].items()}
+
+metrics.register(metrics.Gauge('isari_queue_depth', 'Requests waiting in each inference queue.', queue_depths))
+metrics.register(metrics.Gauge('isari_model_registry_hit_rate', 'Share of model lookups served by an already loaded model.', model_registry_gauge('hit_rate')))
+metrics.register(metrics.Gauge('isari_model_registry_evictions', 'Models evicted from the registry since startup.', model_registry_gauge('evictions')))
+metrics.register(metrics.Gauge('isari_model_registry_load_seconds_total', 'Time spent loading models into the registry.', model_registry_gauge('total_load_time')))
+metrics.register(metrics.Gauge('isari_model_load_seconds', 'Load time of each resident model.', model_load_seconds))
+metrics.register(metrics.Gauge('isari_gpu_memory_allocated_bytes', 'GPU memory allocated by torch models.', gpu_memory_bytes))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready', methods=['GET'])
+def readiness_route():
+    is_ready, report = startup.readiness()
+    # Report unready while draining so the load balancer stops sending traffic
+    is_ready = is_ready and not serving.draining
+    report['draining'] = serving.draining
+    report['model_registry'] = model_registry_stats()
+    return jsonify(report), 200 if is_ready else 503
+
+@app.route('/deepfakeBatcherStats', methods=['GET'])
+def deepfake_batcher_stats_route():
+    return jsonify(deepfake_batcher.stats())
+
+@app.route('/resultCacheStats', methods=['GET'])
+def result_cache_stats_route():
+    return jsonify(result_cache.stats())
+
+# Streaming inference endpoints import the model stack on first use
+@app.route('/streamInferenceWithPhi3Mini', methods=['POST'])
+def stream_inference_with_phi3_mini_route():
+    from inference_endpoints import stream_inference_with_phi3_mini_endpoint
+    return stream_inference_with_phi3_mini_endpoint()
+
+def emit_stream(events):
+    for event, payload in events:
+        emit(event, payload)
+        socketio.sleep(0)  # Yield so each token is flushed to the client immediately
+
+@socketio.on('streamInferenceWithPhi3Mini')
+def handle_stream_inference_with_phi3_mini(data):
+    from inference_endpoints import stream_inference_with_phi3_mini
+    from batch_scheduler import QueueFullError
+    try:
+        events = stream_inference_with_phi3_mini(data.get('input_text', ''))
+    except QueueFullError:
+        emit('inferenceError', {'message': 'Server is busy, please try again later.'})
+        return
+    emit_stream(events)
+
+# The Hugging Face pipeline runs one blocking generate() on its own thread, and its hooks
+# emit to Socket.IO from that thread. Under eventlet or gevent that thread is a green
+# thread that would stall every socket for the whole generation, so these endpoints are
+# only served in threading mode.
+if serving.async_mode == 'threading':
+    @app.route('/streamInference', methods=['POST'])
+    def stream_inference_route():
+        from inference_endpoints import stream_inference_endpoint
+        return stream_inference_endpoint()
+
+    @socketio.on('streamInference')
+    def handle_stream_inference(data):
+        from inference_endpoints import stream_inference
+        emit_stream(stream_inference(data.get('input_text', '')))
+else:
+    logger.warning(f"/streamInference is disabled in {serving.async_mode} mode; use SOCKETIO_ASYNC_MODE=threading to serve the Hugging Face model.")
+
 # @app.route('/runInferenceWithPhi3Mini', methods=['POST'])
 # def run_inference_with_phi3_mini_route():
 #     return run_inference_endpoint()
 
+def warm_up_phi3():
+    inference_endpoints = startup.timed_import('inference_endpoints')
+    inference_endpoints.og_model_registry.warm_up([inference_endpoints.phi3_model_path])
+    return inference_endpoints.og_model_registry
+
+# Load the resident ONNX models alongside the other models when asked to
+if os.getenv('WARM_UP_MODELS') == "true":
+    startup.register('phi3_mini', warm_up_phi3)
+
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=3001, debug=True)
+    # Models load in parallel while the server is already accepting connections;
+    # /ready reports 503 until every required model is loaded
+    startup.start_background_loading()
+
+    # SERVER_MODE=production runs without the debugger and reloader and drains on SIGTERM
+    serving.run(socketio, app, host='0.0.0.0', port=3001)
@@ -0,0 +1,124 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from log_setup import stop_logging
+
+logger = logging.getLogger(__name__)
+
+# Serving configuration, read before anything else is imported
+server_mode = os.getenv('SERVER_MODE', 'debug')
+async_mode = os.getenv('SOCKETIO_ASYNC_MODE', 'threading')
+cpu_workers = int(os.getenv('CPU_WORKERS', str(os.cpu_count() or 1)))
+shutdown_grace_seconds = float(os.getenv('SHUTDOWN_GRACE_SECONDS', '30'))
+message_queue = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+
+executor = None
+draining = False
+in_flight = 0
+in_flight_lock = threading.Lock()
+worker_state = threading.local()
+
+def monkey_patch():
+    """
+    Patch the standard library for the green worker model; must run before other imports.
+    """
+    global in_flight_lock, worker_state
+    if async_mode == 'eventlet':
+        # eventlet sizes its native thread pool from the environment on import
+        os.environ.setdefault('EVENTLET_THREADPOOL_SIZE', str(cpu_workers))
+        import eventlet
+        eventlet.monkey_patch()
+    elif async_mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    in_flight_lock = threading.Lock()
+    worker_state = threading.local()
+
+def run_on_worker(fn):
+    def run(*args, **kwargs):
+        worker_state.on_worker = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            worker_state.on_worker = False
+    return run
+
+def offload(fn, *args, **kwargs):
+    """
+    Run a CPU-bound call on a native worker thread so the event loop keeps serving sockets.
+
+    Under eventlet and gevent the calling greenlet yields until the result is ready; in
+    threading mode the calling thread waits on the shared executor.
+    """
+    global executor
+    # Nested calls from a worker thread run inline instead of waiting on the pool they occupy
+    if getattr(worker_state, 'on_worker', False):
+        return fn(*args, **kwargs)
+    fn = run_on_worker(fn)
+    if async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    if async_mode == 'gevent':
+        import gevent
+        threadpool = gevent.get_hub().threadpool
+        threadpool.maxsize = cpu_workers
+        return threadpool.apply(fn, args, kwargs)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="cpu-worker")
+    return executor.submit(fn, *args, **kwargs).result()
+
+def request_started():
+    global in_flight
+    with in_flight_lock:
+        in_flight += 1
+
+def request_finished():
+    global in_flight
+    with in_flight_lock:
+        in_flight -= 1
+
+def install_shutdown_handlers(socketio):
+    """
+    On SIGTERM/SIGINT stop reporting ready, let in-flight requests finish, then exit.
+    """
+    def drain():
+        deadline = time.monotonic() + shutdown_grace_seconds
+        while in_flight > 0 and time.monotonic() < deadline:
+            socketio.sleep(0.1)
+        logger.info(f"Shutting down with {in_flight} requests still in flight.")
+        if executor is not None:
+            executor.shutdown(wait=False)
+        stop_logging()
+        sys.stdout.flush()
+        os._exit(0)
+
+    def handle_signal(signum, frame):
+        global draining
+        if draining:
+            return
+        draining = True
+        logger.info(f"Received signal {signum}, draining for up to {shutdown_grace_seconds:.0f}s.")
+        socketio.start_background_task(drain)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+def run(socketio, app, host, port):
+    """
+    Start the Socket.IO server in the configured mode.
+    """
+    if server_mode != 'production':
+        socketio.run(app, host=host, port=port, debug=True)
+        return
+
+    install_shutdown_handlers(socketio)
+    logger.info(f"Serving on {host}:{port} with {async_mode} workers and {cpu_workers} CPU workers.")
+    run_args = {'host': host, 'port': port, 'debug': False, 'use_reloader': False}
+    if async_mode == 'threading':
+        # The threaded Werkzeug server is the only option without eventlet or gevent installed
+        run_args['allow_unsafe_werkzeug'] = True
+    socketio.run(app, **run_args)
@@ -0,0 +1,110 @@
+import importlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from serving import offload
+
+logger = logging.getLogger(__name__)
+
+# Seconds spent importing each heavy module, recorded by timed_import
+import_times = {}
+import_times_lock = threading.Lock()
+
+def timed_import(module_name):
+    """
+    Import module_name and record how long the first import took.
+    """
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    elapsed = time.perf_counter() - start
+    with import_times_lock:
+        # Later imports hit sys.modules and would only record ~0s
+        import_times.setdefault(module_name, elapsed)
+    return module
+
+class LazyResource:
+    """
+    A model or other expensive object that is loaded once, on first use or in the background.
+    """
+
+    def __init__(self, name, loader, required=True):
+        """
+        Initialize the resource.
+
+        :param name: Name reported by the readiness endpoint
+        :param loader: Callable returning the loaded object
+        :param required: Whether the server is only ready once this resource has loaded
+        """
+        self.name = name
+        self.loader = loader
+        self.required = required
+        self.state = 'pending'
+        self.load_time = None
+        self.error = None
+        self._value = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def load(self):
+        with self._lock:
+            if self.state != 'pending':
+                return
+            self.state = 'loading'
+        start = time.perf_counter()
+        try:
+            # Loading runs on a native thread so green workers keep serving meanwhile
+            self._value = offload(self.loader)
+            self.state = 'ready'
+        except Exception as e:
+            self.error = str(e)
+            self.state = 'failed'
+            logger.exception(f"Failed to load {self.name}: {e}")
+        finally:
+            self.load_time = time.perf_counter() - start
+            self._ready.set()
+        logger.info(f"{self.name} {self.state} after {self.load_time:.2f}s.")
+
+    def get(self, timeout=None):
+        """
+        Return the loaded object, loading it on this thread if nobody has started yet.
+        """
+        self.load()
+        if not self._ready.wait(timeout):
+            raise TimeoutError(f"{self.name} is still loading.")
+        if self.state == 'failed':
+            raise RuntimeError(f"{self.name} failed to load: {self.error}")
+        return self._value
+
+    def status(self):
+        return {
+            'state': self.state,
+            'required': self.required,
+            'load_time': self.load_time,
+            'error': self.error,
+        }
+
+resources = {}
+
+def register(name, loader, required=True):
+    resources[name] = LazyResource(name, loader, required=required)
+    return resources[name]
+
+def start_background_loading(max_workers=None):
+    """
+    Load every registered resource in parallel without blocking the caller.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers or max(len(resources), 1), thread_name_prefix="model-loader")
+    for resource in resources.values():
+        executor.submit(resource.load)
+    executor.shutdown(wait=False)
+
+def readiness():
+    """
+    Return (is_ready, report) for the readiness endpoint.
+    """
+    models = {name: resource.status() for name, resource in resources.items()}
+    is_ready = all(status['state'] == 'ready' for status in models.values() if status['required'])
+    with import_times_lock:
+        report = {'ready': is_ready, 'models': models, 'import_times': dict(import_times)}
+    return is_ready, report
@@ -0,0 +1,87 @@
+import json
+import logging
+import time
+from flask import Response, stream_with_context
+
+logger = logging.getLogger(__name__)
+
+
+class StreamStats:
+    """
+    Time-to-first-token and throughput bookkeeping for a single token stream.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.end_time = None
+        self.token_count = 0
+
+    def record_token(self):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.token_count += 1
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def to_dict(self):
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        time_to_first_token = None
+        tokens_per_second = 0.0
+        if self.first_token_time is not None:
+            time_to_first_token = self.first_token_time - self.start_time
+            decode_time = end_time - self.first_token_time
+            if decode_time > 0 and self.token_count > 1:
+                tokens_per_second = (self.token_count - 1) / decode_time
+        return {
+            "time_to_first_token": time_to_first_token,
+            "tokens_per_second": tokens_per_second,
+            "token_count": self.token_count,
+            "total_time": end_time - self.start_time,
+        }
+
+
+def stream_events(token_iterator):
+    """
+    Turn an iterator of decoded tokens into (event, payload) pairs.
+
+    Yields an 'inferenceToken' event per token followed by a single 'inferenceDone'
+    event carrying the full output and the stream statistics. If generation fails
+    part way, the stream ends with an 'inferenceError' event instead.
+    """
+    stats = StreamStats()
+    generated_tokens = []
+    try:
+        for token in token_iterator:
+            if not token:
+                continue
+            stats.record_token()
+            generated_tokens.append(token)
+            yield 'inferenceToken', {'token': token}
+    except Exception as e:
+        # The response has already started, so the client is told through the stream
+        logger.exception(f"Error during streaming inference: {e}")
+        yield 'inferenceError', {'message': 'Internal server error.'}
+        return
+    stats.finish()
+    yield 'inferenceDone', {'output': "".join(generated_tokens), 'stats': stats.to_dict()}
+
+
+def format_sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def sse_response(events):
+    """
+    Wrap (event, payload) pairs in a chunked text/event-stream response.
+    """
+    def generate():
+        for event, payload in events:
+            yield format_sse(event, payload)
+
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Stop reverse proxies from buffering the stream
+    }
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
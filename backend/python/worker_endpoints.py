@@ -1,34 +1,160 @@
+import logging
 import os
+
+# Upload limits, applied before and after decoding the profile picture
+max_upload_bytes = int(os.getenv('MAX_UPLOAD_BYTES', str(10 * 1024 ** 2)))
+max_image_pixels = int(os.getenv('MAX_IMAGE_PIXELS', str(40 * 1000 ** 2)))
+
+# OpenCV reads its decoder pixel limit from the environment when it is imported
+os.environ.setdefault('OPENCV_IO_MAX_IMAGE_PIXELS', str(max_image_pixels))
+
+import io
 import cv2
 import numpy as np
-import tensorflow as tf
-import json
-from flask import request, jsonify
+from flask import Request, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
+from micro_batcher import MicroBatcher
+from deepfake_runtime import deepfake_model_paths, input_size, load_deepfake_backend
+from face_detection import load_face_detector, prepare_model_input
+from result_cache import ResultCache, SqliteResultStore, content_key
+from serving import offload
+from metrics import cache_lookups, timed
+from log_setup import log_fields
+import startup
 
-# Load OpenCV's pre-trained Haar Cascade classifier for face detection
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+logger = logging.getLogger(__name__)
 
-# Paths to the model files
-model_weights_path = os.path.join(os.path.dirname(__file__), 'models', 'model.weights.h5')
-model_config_path = os.path.join(os.path.dirname(__file__), 'models', 'config.json')
+# Face detector selected by FACE_DETECTOR, loaded on first use or at startup
+face_detector = startup.register('face_detector', load_face_detector)
 
-# Load the model architecture from the config file
-with open(model_config_path, 'r') as json_file:
-    model_config = json.load(json_file)
+# Whether the deepfake model sees the detected face crop ('face') or the whole image ('image')
+deepfake_input = os.getenv('DEEPFAKE_INPUT', 'face')
 
-# Reconstruct the model from the JSON configuration
-deepfake_model = tf.keras.models.model_from_json(
-    json.dumps(model_config), 
-    custom_objects={"EfficientNetV2Backbone": tf.keras.applications.EfficientNetV2B0}
+# The deepfake detector, with the runtime selected by DEEPFAKE_RUNTIME
+deepfake_backend = startup.register('deepfake_model', load_deepfake_backend)
+
+# Concurrent requests are gathered into batched forward passes. The backend is resolved
+# on the batcher thread: waiting for it inside an offload worker could hold the only
+# worker that its background loader needs.
+deepfake_batcher = MicroBatcher(
+    lambda images: offload(timed_predict_batch, deepfake_backend.get(), images),
+    max_batch_size=int(os.getenv('DEEPFAKE_MAX_BATCH_SIZE', '16')),
+    max_wait_ms=float(os.getenv('DEEPFAKE_MAX_WAIT_MS', '5')),
 )
 
-# Build the model with the defined input shape
-input_shape = (1, 224, 224, 3)
-sample_input = np.zeros(input_shape)
-deepfake_model(sample_input)  # Call the model once with a sample input
+# Repeat submissions of the same photo are answered from a content-hash result cache.
+# The model version covers everything that changes the analysis of a given image.
+deepfake_runtime = os.getenv('DEEPFAKE_RUNTIME', 'keras')
+deepfake_model_path = deepfake_model_paths.get(deepfake_runtime, '')
+model_version = ":".join([
+    deepfake_runtime,
+    os.getenv('FACE_DETECTOR', 'haar'),
+    deepfake_input,
+    str(os.path.getmtime(deepfake_model_path)) if os.path.exists(deepfake_model_path) else 'no-model',
+])
+result_cache_path = os.getenv('RESULT_CACHE_PATH')
+result_cache = ResultCache(
+    max_entries=int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1024')),
+    ttl_seconds=float(os.getenv('RESULT_CACHE_TTL_SECONDS', '3600')),
+    store=SqliteResultStore(result_cache_path, int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1024'))) if result_cache_path else None,
+)
+
+def timed_predict_batch(backend, images):
+    with timed('deepfake_predict'):
+        return backend.predict_batch(images)
+
+class ImageUploadError(Exception):
+    """
+    Raised when an uploaded image is too large or cannot be decoded.
+    """
+
+    def __init__(self, message, status_code=200):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+class InMemoryUploadRequest(Request):
+    """
+    Request that keeps multipart file parts in memory.
+
+    Werkzeug's default spools any part over 500 KB to a temporary file. The whole body
+    is already bounded by MAX_CONTENT_LENGTH, so uploads stay in a BytesIO instead.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+def read_upload(file_storage):
+    """
+    Read an uploaded file from the request stream, enforcing the upload size limit.
+
+    :param file_storage: Uploaded file from request.files
+    :return: Raw file bytes, as a view of the in-memory upload when possible
+    """
+    stream = file_storage.stream
+    if isinstance(stream, io.BytesIO):
+        data = stream.getbuffer()
+    else:
+        # Read one byte past the limit so oversized uploads are detected without reading them fully
+        data = stream.read(max_upload_bytes + 1)
+    if len(data) > max_upload_bytes:
+        raise ImageUploadError(f'Image exceeds the {max_upload_bytes} byte upload limit.', 413)
+    return data
+
+def decode_image(data):
+    """
+    Decode raw image bytes in memory, without touching the disk.
+
+    :param data: Raw file bytes
+    :return: Decoded BGR image
+    """
+    try:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    except cv2.error:
+        img = None
+    if img is None:
+        raise ImageUploadError('Error loading image.')
+
+    height, width = img.shape[:2]
+    if height * width > max_image_pixels:
+        raise ImageUploadError(f'Image exceeds the {max_image_pixels} pixel limit.', 413)
+    return img
 
-# Load the model weights
-deepfake_model.load_weights(model_weights_path)
+def analyze_image(img):
+    """
+    Run face detection and deepfake detection on a decoded image.
+
+    :return: (face_detected, analysis_result)
+    """
+    analysis_result = {}
+    face_detected = False
+
+    # Detect faces in the image on a CPU worker thread
+    with timed('face_detection'):
+        faces = offload(face_detector.get().detect, img)
+
+    if len(faces) > 0:
+        face_detected = True
+
+        # DeepFake detection using EfficientNetV2 on the detected face
+        with timed('preprocess'):
+            img_array = offload(prepare_model_input, img, faces, input_size, deepfake_input == 'face')
+        with timed('deepfake_wait'):
+            deepfake_prediction = deepfake_batcher.predict(img_array)
+
+        # Extract the scalar value from the prediction array
+        is_real = deepfake_prediction < 0.5  # Adjust threshold if necessary
+        is_real = bool(np.any(is_real))  # Convert to a boolean value
+
+        analysis_result['is_real'] = is_real
+
+        # Print the analysis result
+        logger.info("Analysis complete", **log_fields(analysis_result=analysis_result))
+    else:
+        logger.info("No face detected in the image.")
+        analysis_result['is_real'] = None
+
+    return face_detected, analysis_result
 
 def analyze_worker_data():
     try:
@@ -41,51 +167,31 @@ def analyze_worker_data():
         # Handle file data
         if 'profilePic' in request.files:
             profile_pic = request.files['profilePic']
-            print("Profile Pic Filename:", profile_pic.filename)
-            
-            # Save the profile picture to the same directory as server.py
-            save_path = os.path.join(os.path.dirname(__file__), profile_pic.filename)
-            profile_pic.save(save_path)
+            logger.debug("Received profile picture", **log_fields(filename=profile_pic.filename))
             
-            # Load the image using OpenCV
-            img = cv2.imread(save_path)
-            if img is None:
-                print("Error loading image with OpenCV.")
-                return jsonify({'success': False, 'message': 'Error loading image.'})
-            
-            # Convert image to grayscale for face detection
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            # Detect faces in the image
-            faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-            
-            if len(faces) > 0:
-                face_detected = True
-                
-                # DeepFake detection using EfficientNetV2
-                img_array = cv2.resize(img, (224, 224))  # Adjust size if necessary
-                img_array = img_array.astype('float32') / 255.0
-                img_array = np.expand_dims(img_array, axis=0)
-                deepfake_prediction = deepfake_model.predict(img_array)
-                
-                # Extract the scalar value from the prediction array
-                is_real = deepfake_prediction[0] < 0.5  # Adjust threshold if necessary
-                is_real = bool(np.any(is_real))  # Convert to a boolean value
-                
-                analysis_result['is_real'] = is_real
-                
-                # Print the analysis result
-                print("Analysis Result:", analysis_result)
-            else:
-                print("No face detected in the image.")
-                analysis_result['is_real'] = None
-
-            # Delete the image after analysis
+            # Read the upload in memory and check whether this exact photo was analyzed before
             try:
-                os.remove(save_path)
-                print("Profile Pic removed successfully.")
-            except Exception as e:
-                print(f"Error deleting profile pic: {e}")
+                upload = read_upload(profile_pic)
+            except ImageUploadError as e:
+                logger.warning(f"Error loading image with OpenCV: {e.message}")
+                return jsonify({'success': False, 'message': e.message}), e.status_code
+            cache_key = content_key(upload, model_version)
+            cached = result_cache.get(cache_key)
+            cache_lookups.inc(cache='result', result='miss' if cached is None else 'hit')
+
+            if cached is not None:
+                face_detected = cached['face_detected']
+                analysis_result = cached['analysis_result']
+                logger.info("Analysis served from cache", **log_fields(analysis_result=analysis_result))
+            else:
+                try:
+                    with timed('upload_decode'):
+                        img = offload(decode_image, upload)
+                except ImageUploadError as e:
+                    logger.warning(f"Error loading image with OpenCV: {e.message}")
+                    return jsonify({'success': False, 'message': e.message}), e.status_code
+                face_detected, analysis_result = analyze_image(img)
+                result_cache.set(cache_key, {'face_detected': face_detected, 'analysis_result': analysis_result})
         
         # Prepare the response
         response = {
@@ -94,7 +200,12 @@ def analyze_worker_data():
             'analysis_result': analysis_result
         }
         return jsonify(response)
-    
+
+    except RequestEntityTooLarge:
+        # The whole body went over MAX_CONTENT_LENGTH while the form was being parsed
+        message = f'Image exceeds the {max_upload_bytes} byte upload limit.'
+        logger.warning(f"Error loading image with OpenCV: {message}")
+        return jsonify({'success': False, 'message': message}), 413
     except Exception as e:
-        print(f"Error during analyze_worker_data: {e}")
+        logger.exception(f"Error during analyze_worker_data: {e}")
         return jsonify({'success': False, 'message': 'Internal server error.'}), 500